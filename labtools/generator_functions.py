@@ -4,54 +4,237 @@ labtools.generator_functions
 """
 import pandas as pd
 
-from numpy import arange
+from collections import OrderedDict
+from hashlib import md5
+from numpy import (arange, argsort, array, asarray, bincount, broadcast_to, 
+                   concatenate, cumsum, empty, inf, isnan, lexsort, maximum, 
+                   min_scalar_type, minimum, newaxis, nonzero, ones, repeat, 
+                   split, where)
 from numpy.random import RandomState
 
-def _circular_generator(source, prng=None):
+__all__ = ['SourceCursor', 'generate', 'generate_by_group', 
+           'set_source_map_cache_size', 'clear_source_map_cache', 
+           'create_source_map', 'generate_matches', 'generate_but_not', 
+           'generate_within']
+
+_source_map_cache = OrderedDict()
+_source_map_cache_size = 32
+
+class SourceCursor(object):
     """
-    Yield rows from source with optional randomization.
+    Position in a circular walk through the rows of a source.
     
-    :param pandas.DataFrame source: Frame to yield from.
-    :param prng: Optional randomizer.
-    :type prng: numpy.random.RandomState or None
-    :return: Yields rows from source.
-    :rtype: pandas.Series
+    Rows are visited in the order of a permutation of the source. If a seed
+    is provided, the permutation is shuffled before the first cycle and again
+    after every completed cycle, so each cycle is a fresh permutation of the
+    source. The cursor only stores the permutation, the offset into it, and
+    the randomizer, so it can be pickled and used to continue the walk across
+    calls, participants, or sessions.
+    
+    :param int num_options: Number of rows in the source.
+    :param seed: Seed random number generator. If `None` the rows are visited
+        in order.
+    :type seed: int or None
     """
-    ix_options = source.index.tolist()
-    num_options = len(ix_options)
+    def __init__(self, num_options, seed=None):
+        if num_options == 0:
+            raise ValueError('cannot generate from an empty source')
+        
+        self.prng = None
+        if seed is not None:
+            self.prng = RandomState(seed)
+        
+        dtype = min_scalar_type(num_options - 1)
+        self.permutation = arange(num_options, dtype=dtype)
+        self.offset = 0
+        
+        if self.prng is not None:
+            self.prng.shuffle(self.permutation)
     
-    if prng is not None:
-        prng.shuffle(ix_options)
+    def __len__(self):
+        return len(self.permutation)
     
-    ix = 0
-    while True:
-        next_ix = ix_options[ix]
-        yield source.ix[next_ix]
-        ix = (ix+1)%num_options
+    def take(self, length):
+        """
+        Advance the cursor, returning the positions it moved over.
+        
+        :param int length: Number of positions to return.
+        :return: Positions into the source.
+        :rtype: numpy.ndarray
+        """
+        num_options = len(self.permutation)
+        
+        if self.prng is None:
+            positions = (self.offset + arange(length)) % num_options
+            self.offset = (self.offset + length) % num_options
+            return positions
+        
+        cycles = []
+        while length > 0:
+            stop = min(self.offset + length, num_options)
+            cycles.append(self.permutation[self.offset:stop].astype(int))
+            length -= stop - self.offset
+            self.offset = stop
+            
+            if self.offset == num_options:
+                self.prng.shuffle(self.permutation)
+                self.offset = 0
         
-        if prng is not None and ix%num_options == 0:
-            prng.shuffle(ix_options)
+        return concatenate(cycles + [arange(0)])
 
-def generate(frame, source, source_cols=None, seed=None):
+def _align_categories(sources):
     """
-    Adds columns to a trial list from a source using a circular generator.
+    Give categorical columns the same categories across several sources.
     
-    :param pandas.DataFrame frame: Trial list.
-    :param pandas.DataFrame source: Source list.
-    :param source_cols: Columns of `source` to add to `frame`. Defaults to
-        adding all columns of `source`. If `source_cols` is a dict, keys will be 
-        renamed to values.
-    :type source_cols: str, list, dict, or None
-    :param seed: Seed random number generator.
-    :type seed: int or None
-    :return: The `frame` with additional `source_cols` from `source`.
-    :rtype: pandas.DataFrame
+    Pieces of a trial list generated from different sources are stitched back
+    together, and pandas only keeps a categorical dtype when the categories of
+    every piece agree. Columns that are categorical in any source are set to
+    the union of values over all sources, in order of appearance.
+    
+    :param list sources: pandas.DataFrame sources.
+    :return: Sources with aligned categorical columns.
+    :rtype: list
     """
-    prng = None
+    is_categorical = pd.api.types.is_categorical_dtype
+    categories = {}
+    for source in sources:
+        for col in source.columns:
+            if is_categorical(source[col]):
+                categories[col] = []
     
-    if seed is not None:
-        prng = RandomState(seed)
+    for col, levels in categories.items():
+        seen = set()
+        for source in sources:
+            if col not in source.columns:
+                continue
+            if is_categorical(source[col]):
+                values = source[col].cat.categories
+            else:
+                values = source[col].dropna().unique()
+            new_levels = [v for v in values if v not in seen]
+            seen.update(new_levels)
+            levels.extend(new_levels)
+    
+    if not categories:
+        return list(sources)
+    
+    aligned = []
+    for source in sources:
+        source = source.copy()
+        for col, levels in categories.items():
+            if col in source.columns:
+                source[col] = source[col].astype('category')
+                source[col] = source[col].cat.set_categories(levels)
+        aligned.append(source)
+    return aligned
+
+def _sample_ordered(sizes, num_samples, prng):
+    """
+    Draw random ordered samples without replacement for many groups at once.
+    
+    Values are drawn with replacement and repeats are rejected, which matches
+    taking the first values of a random permutation without building it. Use
+    only when the samples are small relative to the sizes.
+    
+    :param numpy.ndarray sizes: Number of options in each group.
+    :param numpy.ndarray num_samples: Number of values to draw for each group.
+    :param numpy.random.RandomState prng: Randomizer.
+    :return: Samples for every group, concatenated in group order.
+    :rtype: numpy.ndarray
+    """
+    num_groups = len(sizes)
+    groups = arange(0)
+    values = arange(0)
+    pending = num_samples
+    while pending.sum():
+        new_groups = repeat(arange(num_groups), pending)
+        new_values = (prng.random_sample(len(new_groups)) *
+                      sizes[new_groups]).astype(int)
+        groups = concatenate([groups, new_groups])
+        values = concatenate([values, new_values])
+        
+        # keep the first draw of each value within each group
+        order = lexsort((arange(len(values)), values, groups))
+        repeated = (groups[order][1:] == groups[order][:-1]) & \
+                   (values[order][1:] == values[order][:-1])
+        keep = ones(len(values), dtype=bool)
+        keep[order[1:][repeated]] = False
+        groups, values = groups[keep], values[keep]
+        
+        pending = num_samples - bincount(groups, minlength=num_groups)
+    
+    return values[argsort(groups, kind='mergesort')]
+
+def _group_positions(codes, sizes, prng=None):
+    """
+    Build circular positions for many groups at once.
+    
+    Each row of a trial list belongs to the group given by its code. Rows in
+    the same group cycle through the options of that group in the same way as
+    a :class:`SourceCursor`: a new permutation of the options is used for
+    every cycle when `prng` is provided.
+    
+    Only complete cycles are laid out in full. A final partial cycle that is
+    small relative to its group is drawn by :func:`_sample_ordered`, so the
+    work and memory needed scale with the number of rows rather than with the
+    size of every group.
+    
+    :param numpy.ndarray codes: Group code of each row, from 0 to
+        ``len(sizes)-1``.
+    :param numpy.ndarray sizes: Number of options in each group.
+    :param prng: Optional randomizer.
+    :type prng: numpy.random.RandomState or None
+    :return: Position of each row within the options of its group.
+    :rtype: numpy.ndarray
+    """
+    num_groups = len(sizes)
+    counts = bincount(codes, minlength=num_groups)
+    if ((sizes == 0) & (counts > 0)).any():
+        raise ValueError('cannot generate from an empty source')
+    
+    # position of each row among the rows of its group (groupby.cumcount)
+    starts = cumsum(counts) - counts
+    order = argsort(codes, kind='mergesort')
+    within = empty(len(codes), dtype=int)
+    within[order] = arange(len(codes)) - repeat(starts, counts)
     
+    safe_sizes = maximum(sizes, 1)
+    if prng is None:
+        return within % safe_sizes[codes]
+    
+    full_cycles = counts // safe_sizes
+    remainder = counts - full_cycles * sizes
+    dense = 2 * remainder > sizes
+    sparse_remainder = where(dense, 0, remainder)
+    
+    # lay out every cycle to permute back to back and shuffle each cycle by
+    # sorting on a random key within the cycle
+    cycles = full_cycles + dense
+    cells = cycles * sizes
+    cell_starts = cumsum(cells) - cells
+    cell_group = repeat(arange(num_groups), cells)
+    cell_within = arange(cells.sum()) - cell_starts[cell_group]
+    cell_cycle = (cumsum(cycles) - cycles)[cell_group] + \
+        cell_within // sizes[cell_group]
+    
+    shuffled = lexsort((prng.random_sample(len(cell_within)), cell_cycle))
+    cell_options = (cell_within % sizes[cell_group])[shuffled]
+    
+    sparse_options = _sample_ordered(safe_sizes, sparse_remainder, prng)
+    sparse_starts = cumsum(sparse_remainder) - sparse_remainder
+    
+    group_cells = cells[codes]
+    in_cells = within < group_cells
+    options = empty(len(codes), dtype=int)
+    options[in_cells] = cell_options[(cell_starts[codes] + within)[in_cells]]
+    options[~in_cells] = sparse_options[(sparse_starts[codes] + within - 
+                                         group_cells)[~in_cells]]
+    return options
+
+def _source_col_map(source_cols, source):
+    """
+    Normalize the `source_cols` argument to a dict of old to new names.
+    """
     if source_cols is None:
         source_cols = source.columns
     elif not hasattr(source_cols, '__iter__'):
@@ -60,16 +243,53 @@ def generate(frame, source, source_cols=None, seed=None):
     if not isinstance(source_cols, dict):
         source_cols = dict(zip(source_cols, source_cols))
     
-    gen = _circular_generator(source, prng)
-    g_frame = pd.concat([gen.next() for _ in xrange(len(frame))], axis=1).T
-    g_frame = g_frame.convert_objects(convert_numeric = True)
-    g_frame = g_frame[source_cols.keys()].rename(columns = source_cols)
+    return source_cols
+
+def _add_from_source(frame, source, positions, source_cols):
+    """
+    Add the rows of `source` at `positions` to `frame` as new columns.
+    """
+    g_frame = source[source_cols.keys()].take(positions)
+    g_frame = g_frame.rename(columns = source_cols)
     
     g_frame.index = frame.index
     frame[source_cols.values()] = g_frame[source_cols.values()]
     
     return frame
 
+def generate(frame, source, source_cols=None, seed=None, cursor=None):
+    """
+    Adds columns to a trial list from a source using a circular generator.
+    
+    To keep rotating through the same source across calls, pass a
+    :class:`SourceCursor`. The cursor is advanced by the length of `frame`, so
+    the next call picks up where this one left off.
+    
+    :param pandas.DataFrame frame: Trial list.
+    :param pandas.DataFrame source: Source list.
+    :param source_cols: Columns of `source` to add to `frame`. Defaults to
+        adding all columns of `source`. If `source_cols` is a dict, keys will be 
+        renamed to values.
+    :type source_cols: str, list, dict, or None
+    :param seed: Seed random number generator. Ignored if `cursor` is given.
+    :type seed: int or None
+    :param cursor: Optional cursor into `source` to draw rows from.
+    :type cursor: SourceCursor or None
+    :return: The `frame` with additional `source_cols` from `source`. The new
+        columns keep the dtypes they have in `source`.
+    :rtype: pandas.DataFrame
+    """
+    if cursor is None:
+        cursor = SourceCursor(len(source), seed)
+    elif len(cursor) != len(source):
+        raise ValueError('cursor is for a source of length %d, not %d' % 
+                         (len(cursor), len(source)))
+    
+    source_cols = _source_col_map(source_cols, source)
+    positions = cursor.take(len(frame))
+    
+    return _add_from_source(frame, source, positions, source_cols)
+
 def generate_by_group(frame, by, source_map, source_cols=None, seed=None):
     """
     Adds columns to a trial list from multiple sources.
@@ -78,6 +298,10 @@ def generate_by_group(frame, by, source_map, source_cols=None, seed=None):
     are paired with sources based on unique values in `frame[by]`. See 
     :func:`generate` for more details.
     
+    All chunks are generated in a single pass: the sources are stacked into
+    one table and the circular positions for every chunk are computed together
+    by :func:`_group_positions`.
+    
     :param pandas.DataFrame frame: Trial list.
     :param str by: Grouping column in `frame`. Unique values are used as keys to
         get sources from `source_map`.
@@ -90,43 +314,344 @@ def generate_by_group(frame, by, source_map, source_cols=None, seed=None):
     :param seed: Seed random number generator. If `None` the result will not be
         randomized.
     :type seed: int or None
-    :return: The `frame` with additional `source_cols` from `source`.
+    :return: The `frame` with additional `source_cols` from `source`. 
+        Categorical columns are given the union of categories in the sources
+        used so that they stay categorical in the combined `frame`.
+    :rtype: pandas.DataFrame
+    """
+    group_keys = frame[by].dropna().unique()
+    if len(group_keys) == 0:
+        if len(frame):
+            raise ValueError('frame[%r] contains missing values' % (by,))
+        return frame.copy()
+    
+    sources = _align_categories([source_map[key] for key in group_keys])
+    source_cols = _source_col_map(source_cols, sources[0])
+    sources = [source[source_cols.keys()] for source in sources]
+    
+    sizes = [len(source) for source in sources]
+    offsets = cumsum(sizes) - sizes
+    option_map = {key: arange(offset, offset+size) 
+                  for key, offset, size in zip(group_keys, offsets, sizes)}
+    
+    stacked = pd.concat(sources, ignore_index=True)
+    return _generate_grouped(frame, by, stacked, _map_options(option_map),
+                             source_cols, seed)
+
+def _generate_grouped(frame, by, source, options, source_cols, seed):
+    """
+    Adds columns to a trial list from per-group subsets of a single source.
+    
+    :param pandas.DataFrame frame: Trial list.
+    :param str by: Grouping column in `frame`.
+    :param pandas.DataFrame source: Source list shared by all groups.
+    :param function options: Called with the unique values of `frame[by]`.
+        Returns the number of options for each value and a function that maps
+        group codes and positions within the options of each group to
+        positions in `source`. See :func:`_map_options`.
+    :param source_cols: Normalized columns, see :func:`_source_col_map`.
+    :type source_cols: dict
+    :param seed: Seed random number generator.
+    :type seed: int or None
+    :return: A copy of `frame` with additional `source_cols` from `source`.
     :rtype: pandas.DataFrame
     """
-    # create unique seeds for each part
-    num_seeds = len(frame[by].unique()) + 1
+    prng = None
+    
     if seed is not None:
         prng = RandomState(seed)
-        seeds = list(prng.choice(arange(1000), num_seeds))
-    else:
-        seeds = [None]*num_seeds
+    
+    codes, group_keys = pd.factorize(frame[by])
+    if (codes < 0).any():
+        raise ValueError('frame[%r] contains missing values' % (by,))
+    
+    sizes, lookup = options(group_keys)
+    positions = lookup(codes, _group_positions(codes, sizes, prng))
+    return _add_from_source(frame.copy(), source, positions, source_cols)
+
+def _map_options(option_map):
+    """
+    Options for :func:`_generate_grouped` from arrays of source positions.
+    
+    :param dict option_map: Map of keys to arrays of positions into the source.
+    :return: Function for the `options` argument of :func:`_generate_grouped`.
+    :rtype: function
+    """
+    def _options(group_keys):
+        group_options = [option_map[key] for key in group_keys]
+        sizes = array([len(opts) for opts in group_options], dtype=int)
+        offsets = cumsum(sizes) - sizes
+        flat_options = concatenate(group_options + [arange(0)]).astype(int)
+        
+        def _lookup(codes, ranks):
+            return flat_options[offsets[codes] + ranks]
+        
+        return sizes, _lookup
+    
+    return _options
+
+def _exclusion_options(values):
+    """
+    Options for :func:`_generate_grouped` that exclude each key's own value.
+    
+    The positions of `values` are grouped by value once. The options for a key
+    are the source positions in order with that key's block of positions
+    skipped over, found by a binary search in the block, so memory stays
+    proportional to the source and the number of keys instead of their
+    product.
+    
+    :param pandas.Series values: Source values compared to the keys.
+    :return: Function for the `options` argument of :func:`_generate_grouped`.
+    :rtype: function
+    """
+    index, order, starts, stops = _cached_index(_match_index, values)
+    num_values = len(order)
+    
+    # the r-th option skips every excluded position p_j with p_j - j <= r;
+    # blocks are offset by their code to search them all in one array
+    ordered_ix = arange(num_values)
+    block_codes = stops.searchsorted(ordered_ix, side='right')
+    block_codes[:(starts[0] if len(starts) else num_values)] = -1
+    block_starts = concatenate([[0], starts])[block_codes + 1]
+    skip_keys = block_codes * (num_values + 1) + \
+        (order - (ordered_ix - block_starts))
+    
+    def _options(group_keys):
+        # missing keys have location -1 and index the padding at the end
+        locs = index.get_indexer(group_keys)
+        found = locs >= 0
+        skip_start = concatenate([starts, [0]])[locs]
+        skip_len = concatenate([stops - starts, [0]])[locs]
+        sizes = num_values - skip_len
+        
+        def _lookup(codes, ranks):
+            query = locs[codes] * (num_values + 1) + ranks
+            skipped = skip_keys.searchsorted(query, side='right') - \
+                skip_start[codes]
+            return ranks + where(found[codes], skipped, 0)
+        
+        return sizes, _lookup
+    
+    return _options
+
+def _interval_options(values, tol=None):
+    """
+    Options for :func:`_generate_grouped` from values near each key.
+    
+    `values` are sorted once and the options for each key are a contiguous
+    slice of the sorted positions, found with a binary search. With a `tol`,
+    the slice holds every value within the tolerance window around the key.
+    Without one, it holds every value tied for nearest to the key.
+    
+    :param pandas.Series values: Numeric source values compared to the keys.
+    :param tol: Tolerance around each key. A number is used on both sides of
+        the key, a pair is used as the distance below and above the key.
+    :type tol: float, tuple, or None
+    :return: Function for the `options` argument of :func:`_generate_grouped`.
+    :rtype: function
+    """
+    sorted_values, order = _cached_index(_sorted_index, values)
+    num_values = len(sorted_values)
+    
+    def _options(group_keys):
+        keys = asarray(group_keys, dtype=float)
+        
+        if tol is not None:
+            below, above = tol if hasattr(tol, '__iter__') else (tol, tol)
+            lower, upper = keys - below, keys + above
+        elif num_values == 0:
+            lower, upper = keys, keys
+        else:
+            i = sorted_values.searchsorted(keys)
+            below = sorted_values[maximum(i - 1, 0)]
+            above = sorted_values[minimum(i, num_values - 1)]
+            dist_below = where(i > 0, keys - below, inf)
+            dist_above = where(i < num_values, above - keys, inf)
+            lower = where(dist_below <= dist_above, below, above)
+            upper = where(dist_above <= dist_below, above, below)
         
-    def _generate_for_group(grp):
-        group_key = grp[by].unique()[0]
-        group_source = source_map[group_key]
-        group_frame = generate(grp, group_source, source_cols, seeds.pop())
-        group_frame.index = grp.index
-        return group_frame
+        starts = sorted_values.searchsorted(lower, side='left')
+        sizes = sorted_values.searchsorted(upper, side='right') - starts
+        
+        empty_keys = [key for key, size in zip(group_keys, sizes) if size == 0]
+        if empty_keys:
+            raise ValueError('no source values within %r of %r' % 
+                             (tol, empty_keys))
+        
+        def _lookup(codes, ranks):
+            return order[starts[codes] + ranks]
+        
+        return sizes, _lookup
+    
+    return _options
+
+def set_source_map_cache_size(size):
+    """
+    Sets how many source indexes are kept for reuse.
+    
+    Matching trials to a source requires grouping or sorting the source by the
+    values being matched on. The result is cached so repeated calls with the
+    same source, e.g., one call per participant, skip that step. The least
+    recently used indexes are dropped once more than `size` are cached.
+    
+    :param int size: Maximum number of cached indexes. Use 0 to disable
+        caching.
+    """
+    global _source_map_cache_size
+    _source_map_cache_size = size
+    while len(_source_map_cache) > max(size, 0):
+        _source_map_cache.popitem(last=False)
+
+def clear_source_map_cache():
+    """
+    Drops all cached source indexes. See :func:`set_source_map_cache_size`.
+    """
+    _source_map_cache.clear()
+
+def _cached_index(build, values):
+    """
+    Builds an index of source values, reusing a cached copy if available.
+    
+    Cached indexes are keyed on the kind of index, the name of `values`, and
+    a hash of the contents of `values`, so a source that has changed since it
+    was indexed is indexed again. The result is shared by every call on the
+    same source, so arrays in it must not be modified or handed out without
+    copying.
+    
+    :param function build: Index builder, e.g., :func:`_match_index`.
+    :param pandas.Series values: Source values to index.
+    :return: The result of ``build(values)``.
+    """
+    if _source_map_cache_size <= 0:
+        return build(values)
+    
+    hashed = pd.util.hash_pandas_object(values, index=False).values
+    key = (build.__name__, values.name, str(values.dtype), 
+           md5(hashed.tostring()).hexdigest())
+    
+    try:
+        result = _source_map_cache.pop(key)
+    except KeyError:
+        result = build(values)
+    
+    _source_map_cache[key] = result
+    while len(_source_map_cache) > _source_map_cache_size:
+        _source_map_cache.popitem(last=False)
+    
+    return result
+
+def _match_index(values):
+    """
+    Groups the positions of `values` by value using a hash table.
+    
+    :param pandas.Series values: Values to index.
+    :return: The unique values, the positions of `values` ordered by value, and
+        the start and stop of each unique value in those ordered positions.
+    :rtype: tuple of (pandas.Index, numpy.ndarray, numpy.ndarray, 
+        numpy.ndarray)
+    """
+    codes, uniques = pd.factorize(values)
+    order = argsort(codes, kind='mergesort')
+    
+    # missing values have code -1 and are sorted to the front
+    bounds = cumsum(bincount(codes + 1, minlength=len(uniques) + 1))
+    return pd.Index(uniques), order, bounds[:-1], bounds[1:]
+
+def _broadcast_positions(values, keys, comparison_func, max_bytes):
+    """
+    Evaluates a comparison for many keys at once as a boolean matrix.
     
-    return frame.groupby(by, group_keys=False).apply(_generate_for_group)
+    `comparison_func` is called with `values` as a row and a chunk of `keys`
+    as a column, so NumPy broadcasting compares every key to every value in a
+    single call. Chunks are sized so that a keys by values array of 8 byte
+    elements stays under `max_bytes`.
+    
+    :param numpy.ndarray values: Source values.
+    :param numpy.ndarray keys: Keys to compare against.
+    :param function comparison_func: Broadcastable comparison.
+    :param int max_bytes: Memory ceiling for each chunk.
+    :return: Array of positions into `values` for each key.
+    :rtype: list
+    """
+    chunk_size = max(1, max_bytes // (8 * max(len(values), 1)))
+    
+    key_positions = []
+    for start in xrange(0, len(keys), chunk_size):
+        chunk = keys[start:start+chunk_size]
+        select = comparison_func(values[newaxis, :], chunk[:, newaxis])
+        select = broadcast_to(asarray(select, dtype=bool), 
+                              (len(chunk), len(values)))
+        rows, cols = nonzero(select)
+        bounds = cumsum(bincount(rows, minlength=len(chunk)))[:-1]
+        key_positions.extend(split(cols, bounds))
+    
+    return key_positions
 
-def create_source_map(source, on, source_keys, comparison_func):
+def _sorted_index(values):
+    """
+    Sorts the positions of `values` by value, dropping missing values.
+    
+    :param pandas.Series values: Numeric values to index.
+    :return: The sorted values and their positions in `values`.
+    :rtype: tuple of (numpy.ndarray, numpy.ndarray)
+    """
+    values = asarray(values, dtype=float)
+    present = nonzero(~isnan(values))[0]
+    order = present[argsort(values[present], kind='mergesort')]
+    return values[order], order
+
+def create_source_map(source, on, source_keys, comparison_func=None, 
+                      positions=False, broadcast=False, max_bytes=2**27):
     """
     Splits a source into groups using a comparison function.
     
+    If `comparison_func` is None, the source is split on equality. Equality
+    matching hashes `source[on]` once instead of comparing every key against
+    the whole source.
+    
+    If `broadcast` is True, `comparison_func` is evaluated for many keys at
+    once on NumPy arrays, see :func:`_broadcast_positions`. The function must
+    then broadcast, e.g., ``lambda x, y: abs(x - y) <= 0.1 * y``.
+    
     :param pandas.DataFrame source: Source list.
     :param str on: `source[on]` is used as an operand in `comparison_func`.
     :param list source_keys: Secondary operand in `comparison_func`.
-    :param function comparison_func: Function to compare `source[on]` to 
+    :param comparison_func: Function to compare `source[on]` to 
         `source_keys`. Must return a boolean mask the same length as `source`.
+        Defaults to matching equal values.
+    :type comparison_func: function or None
+    :param bool positions: Should the map contain arrays of positions into
+        `source` instead of subsets of the source? Defaults to False.
+    :param bool broadcast: Should `comparison_func` be called on a keys by
+        source matrix instead of once per key? Defaults to False.
+    :param int max_bytes: Memory ceiling for each broadcast comparison.
+        Defaults to 128 MB.
     :return: Map of source_keys to subsets of the source that satisfy the 
         `comparison_func`
     :rtype: dict
     """
     source_map = {}
-    for key in source_keys:
-        select = comparison_func(source[on], key)
-        source_map[key] = source[select]
+    if comparison_func is None:
+        index, order, starts, stops = _cached_index(_match_index, source[on])
+        for key, loc in zip(source_keys, index.get_indexer(source_keys)):
+            # copy so that edits by the caller cannot reach the cached order
+            if loc < 0:
+                source_map[key] = order[:0].copy()
+            else:
+                source_map[key] = order[starts[loc]:stops[loc]].copy()
+    elif broadcast:
+        keys = asarray(source_keys)
+        key_positions = _broadcast_positions(asarray(source[on]), keys, 
+                                             comparison_func, max_bytes)
+        source_map = dict(zip(keys, key_positions))
+    else:
+        for key in source_keys:
+            select = asarray(comparison_func(source[on], key), dtype=bool)
+            source_map[key] = nonzero(select)[0]
+    
+    if not positions:
+        for key, selected in source_map.items():
+            source_map[key] = source.take(selected)
     
     return source_map
 
@@ -157,14 +682,12 @@ def generate_matches(frame, source, on, source_cols=None, seed=None):
         on = [on, on]
     f_on, s_on = on
     
-    source_keys = frame[f_on].unique()
+    source_keys = frame[f_on].dropna().unique()
+    option_map = create_source_map(source, s_on, source_keys, positions=True)
+    source_cols = _source_col_map(source_cols, source)
     
-    def _is_equal(x, y): 
-        return x == y
-    
-    source_map = create_source_map(source, s_on, source_keys, _is_equal)
-    
-    return generate_by_group(frame, f_on, source_map, source_cols, seed)
+    return _generate_grouped(frame, f_on, source, _map_options(option_map),
+                             source_cols, seed)
 
 def generate_but_not(frame, source, on, source_cols=None, seed=None):
     """
@@ -173,7 +696,7 @@ def generate_but_not(frame, source, on, source_cols=None, seed=None):
     For more information:
         * on how the columns are added, see :func:`generate_by_group`.
         * on how the non-matching values are selected, see 
-          :func:`create_source_map`
+          :func:`_exclusion_options`
     
     :param pandas.DataFrame frame:
     :param pandas.DataFrame source: Full options to split into the source_map.
@@ -193,11 +716,53 @@ def generate_but_not(frame, source, on, source_cols=None, seed=None):
         on = [on, on]
     f_on, s_on = on
     
-    source_keys = frame[f_on].unique()
+    source_cols = _source_col_map(source_cols, source)
+    
+    return _generate_grouped(frame, f_on, source, 
+                             _exclusion_options(source[s_on]), source_cols, 
+                             seed)
+
+def generate_within(frame, source, on, tol=None, source_cols=None, seed=None):
+    """
+    Adds columns to a trial list based on *nearby* values in source.
+    
+    Each trial is matched to the source rows whose numeric value in `on` falls
+    within `tol` of the trial's value. If `tol` is None, trials are matched to
+    the source rows with the nearest value.
+    
+    For more information:
+        * on how the columns are added, see :func:`generate_by_group`.
+        * on how the nearby values are selected, see 
+          :func:`_interval_options`
+    
+    :param pandas.DataFrame frame:
+    :param pandas.DataFrame source: Full options to match against.
+    :param on: Column names to match source and frame on.
+    :type on: str or list
+    :param tol: Tolerance around each value in `frame`. A number is used on
+        both sides, a pair is used as the distance below and above. Must not
+        be negative.
+    :type tol: float, tuple, or None
+    :param source_cols: Columns of `source` to add to `frame`. Defaults to
+        adding all columns of `source`. If `source_cols` is a dict, keys will be 
+        renamed to values.
+    :type source_cols: str, list, dict, or None
+    :param seed: Seed random number generator. If `None` the result will not be
+        randomized.
+    :type seed: int or None
+    :return: The `frame` with additional `source_cols` from sources.
+    :rtype: pandas.DataFrame
+    """
+    if not isinstance(on, list):
+        on = [on, on]
+    f_on, s_on = on
     
-    def _is_not_equal(x, y):
-        return x != y
+    if tol is not None:
+        if (asarray(tol) < 0).any():
+            raise ValueError('tol must not be negative, got %r' % (tol,))
     
-    source_map = create_source_map(source, s_on, source_keys, _is_not_equal)
+    source_cols = _source_col_map(source_cols, source)
     
-    return generate_by_group(frame, f_on, source_map, source_cols, seed)
+    return _generate_grouped(frame, f_on, source, 
+                             _interval_options(source[s_on], tol), 
+                             source_cols, seed)
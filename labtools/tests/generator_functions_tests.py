@@ -5,9 +5,16 @@ import pandas as pd
 from numpy import *
 
 import string
+import pickle
 
 from ..trials_functions import counterbalance, expand
-from ..generator_functions import generate, generate_by_group, generate_but_not
+from ..generator_functions import (generate, generate_by_group, 
+                                   generate_but_not, generate_matches,
+                                   generate_within, create_source_map,
+                                   clear_source_map_cache, 
+                                   set_source_map_cache_size)
+from ..generator_functions import SourceCursor
+from .. import generator_functions
 
 class TestGenerate(unittest.TestCase):
     def setUp(self):
@@ -33,6 +40,36 @@ class TestGenerate(unittest.TestCase):
             matches = (self.trials[col].head(len(self.info)).values == \
                        self.info[col].values)
             self.assertTrue(matches.sum() == len(self.info))
+    
+    def test_seed_cycles(self):
+        cols = ['x','ix']
+        self.trials = generate(self.trials, self.info, source_cols=cols, 
+                               seed=100)
+        num_options = len(self.info)
+        for start in range(0, len(self.trials), num_options):
+            cycle = self.trials[cols][start:start+num_options]
+            self.assertFalse(cycle.duplicated().any())
+    
+    def test_seed_reproducible(self):
+        first = generate(self.trials.copy(), self.info, seed=100)
+        second = generate(self.trials.copy(), self.info, seed=100)
+        self.assertTrue(first.equals(second))
+    
+    def test_cursor(self):
+        whole = generate(self.trials.copy(), self.info, seed=100)
+        
+        cursor = SourceCursor(len(self.info), seed=100)
+        first = generate(self.trials[:77].copy(), self.info, cursor=cursor)
+        cursor = pickle.loads(pickle.dumps(cursor))
+        second = generate(self.trials[77:].copy(), self.info, cursor=cursor)
+        self.assertTrue(whole.equals(pd.concat([first, second])))
+    
+    def test_dtypes(self):
+        self.info['x'] = self.info['x'].astype('category')
+        self.info['code'] = self.info['ix'].astype(str)
+        self.trials = generate(self.trials, self.info, seed=100)
+        for col in ['x', 'ix', 'code']:
+            self.assertEqual(self.trials[col].dtype, self.info[col].dtype)
 
 class TestGenerateByGroup(unittest.TestCase):
     def setUp(self):
@@ -58,6 +95,118 @@ class TestGenerateByGroup(unittest.TestCase):
         
         for y in trials1.unique():
             self.assertTrue(y not in trials0)
+    
+    def test_empty(self):
+        source_map = {0: self.info0, 1: self.info1}
+        empty = generate_by_group(self.trials[:0], 'c', source_map)
+        self.assertEqual(len(empty), 0)
+    
+    def test_categories_aligned(self):
+        self.info0['x'] = self.info0['x'].astype('category')
+        self.info1['x'] = self.info1['x'].astype('category')
+        source_map = {0: self.info0,
+                      1: self.info1}
+        self.trials = generate_by_group(self.trials, 'c', source_map)
+        self.assertTrue(pd.api.types.is_categorical_dtype(self.trials['x']))
+        self.assertEqual(self.trials['ix'].dtype, self.info0['ix'].dtype)
+    
+    def test_group_cycles(self):
+        source_map = {0: self.info0,
+                      1: self.info1}
+        orig_index = self.trials.index
+        self.trials = generate_by_group(self.trials, 'c', source_map, seed=100)
+        self.assertTrue(self.trials.index.equals(orig_index))
+        
+        for key, source in source_map.items():
+            grp = self.trials[self.trials['c'] == key][['x','ix']]
+            num_options = len(source)
+            for start in range(0, len(grp), num_options):
+                cycle = grp[start:start+num_options]
+                self.assertFalse(cycle.duplicated().any())
+
+class TestCreateSourceMap(unittest.TestCase):
+    def setUp(self):
+        self.info = counterbalance({'b':list('abcde'),'ix':range(5)})
+        self.info = self.info.sample(frac=1, random_state=100)
+    
+    def test_equality(self):
+        keys = ['a', 'c', 'z']
+        source_map = create_source_map(self.info, 'b', keys)
+        by_func = create_source_map(self.info, 'b', keys, lambda x,y: x==y)
+        for key in keys:
+            self.assertTrue(source_map[key].equals(by_func[key]))
+        self.assertEqual(len(source_map['z']), 0)
+    
+    def test_positions(self):
+        source_map = create_source_map(self.info, 'b', ['a'], positions=True)
+        selected = self.info['b'].values[source_map['a']]
+        self.assertTrue((selected == 'a').all())
+        self.assertEqual(len(selected), 5)
+    
+    def test_broadcast(self):
+        def _within(x, y):
+            return abs(x - y) <= 1
+        
+        keys = [0, 2, 4, 10]
+        by_key = create_source_map(self.info, 'ix', keys, _within)
+        for max_bytes in [1, 2**20]:
+            broadcast = create_source_map(self.info, 'ix', keys, _within, 
+                                          broadcast=True, max_bytes=max_bytes)
+            for key in keys:
+                self.assertTrue(broadcast[key].equals(by_key[key]))
+
+class TestSourceMapCache(unittest.TestCase):
+    def setUp(self):
+        clear_source_map_cache()
+        self.info = counterbalance({'b':list('abcde'),'ix':range(5)})
+        self.cache = generator_functions._source_map_cache
+    
+    def tearDown(self):
+        set_source_map_cache_size(32)
+        clear_source_map_cache()
+    
+    def test_reuse(self):
+        create_source_map(self.info, 'b', ['a'])
+        cached = self.cache.values()[0]
+        create_source_map(self.info.copy(), 'b', ['b'])
+        self.assertEqual(len(self.cache), 1)
+        self.assertTrue(self.cache.values()[0] is cached)
+    
+    def test_changed_source(self):
+        create_source_map(self.info, 'b', ['a'])
+        self.info.loc[0, 'b'] = 'z'
+        source_map = create_source_map(self.info, 'b', ['z'])
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(len(source_map['z']), 1)
+    
+    def test_size(self):
+        set_source_map_cache_size(1)
+        create_source_map(self.info, 'b', ['a'])
+        create_source_map(self.info, 'ix', [0])
+        self.assertEqual(len(self.cache), 1)
+        set_source_map_cache_size(0)
+        self.assertEqual(len(self.cache), 0)
+    
+    def test_edit_positions(self):
+        source_map = create_source_map(self.info, 'b', ['a'], positions=True)
+        source_map['a'][:] = (self.info['b'] == 'c').values.argmax()
+        source_map = create_source_map(self.info, 'b', ['a', 'c'], 
+                                       positions=True)
+        self.assertTrue((self.info['b'].take(source_map['a']) == 'a').all())
+
+class TestGenerateMatches(unittest.TestCase):
+    def setUp(self):
+        _vars = {'a':random.choice(arange(100), 10, replace=False), 
+                 'b':random.choice(list(string.letters), 10, replace=False),
+                 'c':[0,1]}
+        
+        self.trials = counterbalance(_vars)
+        self.info = counterbalance({'b':_vars['b'],'ix':range(5)})
+    
+    def test_matches(self):
+        self.trials = generate_matches(self.trials, self.info, on='b', 
+                                       source_cols={'b':'xb'}, seed=100)
+        self.assertTrue((self.trials['xb'] == self.trials['b']).all())
 
 class TestGenerateButNot(unittest.TestCase):
     def setUp(self):
@@ -74,6 +223,21 @@ class TestGenerateButNot(unittest.TestCase):
         matches = (self.trials['xb'] == self.trials['b'])
         self.assertTrue(matches.sum() == 0)
     
+    def test_but_not_seed(self):
+        self.trials = generate_but_not(self.trials, self.info, on='b', 
+                                       source_cols={'b':'xb'}, seed=100)
+        matches = (self.trials['xb'] == self.trials['b'])
+        self.assertTrue(matches.sum() == 0)
+    
+    def test_but_not_order(self):
+        self.trials = generate_but_not(self.trials, self.info, on='b', 
+                                       source_cols={'b':'xb','ix':'xix'})
+        for key, grp in self.trials.groupby('b'):
+            expected = self.info[self.info['b'] != key]
+            num_options = min(len(grp), len(expected))
+            self.assertSequenceEqual(list(grp['xix'][:num_options]), 
+                                     list(expected['ix'][:num_options]))
+    
     def test_but_not_separate(self):
         self.info = self.info.rename(columns={'b':'bb'})
         
@@ -82,6 +246,34 @@ class TestGenerateButNot(unittest.TestCase):
         matches = (self.trials['xb'] == self.trials['b'])
         self.assertTrue(matches.sum() == 0)
 
+class TestGenerateWithin(unittest.TestCase):
+    def setUp(self):
+        self.trials = pd.DataFrame({'freq':[100., 200., 310., 400.]*5})
+        self.info = pd.DataFrame({'freq':[95., 105., 190., 300., 390., 900.],
+                                  'ix':range(6)})
+    
+    def test_within(self):
+        self.trials = generate_within(self.trials, self.info, 'freq', tol=20, 
+                                      source_cols={'freq':'xfreq'}, seed=100)
+        diffs = (self.trials['xfreq'] - self.trials['freq']).abs()
+        self.assertTrue((diffs <= 20).all())
+    
+    def test_within_empty(self):
+        self.assertRaises(ValueError, generate_within, self.trials, 
+                          self.info, 'freq', tol=5)
+    
+    def test_negative_tol(self):
+        for tol in [-10, (20, -30)]:
+            self.assertRaises(ValueError, generate_within, self.trials, 
+                              self.info, 'freq', tol=tol)
+    
+    def test_nearest(self):
+        self.trials = generate_within(self.trials, self.info, 'freq', 
+                                      source_cols={'freq':'xfreq'}, seed=100)
+        nearest = {100.:[95., 105.], 200.:[190.], 310.:[300.], 400.:[390.]}
+        for freq, grp in self.trials.groupby('freq'):
+            self.assertItemsEqual(grp['xfreq'].unique(), nearest[freq])
+
 def main():
     unittest.main()
 
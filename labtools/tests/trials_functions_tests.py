@@ -6,7 +6,11 @@ import numpy as np
 
 import string
 
-from ..trials_functions import counterbalance, expand, extend
+from ..trials_functions import (counterbalance, iter_counterbalance, 
+                                unrank_counterbalance, sample_counterbalance,
+                                williams_square, williams_order,
+                                carryover_sequence, expand, extend, add_block,
+                                simple_shuffle, smart_shuffle, min_repeats)
 
 class CounterbalanceTests(unittest.TestCase):
     def test_unique(self):
@@ -32,16 +36,144 @@ class CounterbalanceTests(unittest.TestCase):
         np.random.shuffle(var_order)
         counter = counterbalance(_vars, order=var_order)
         self.assertSequenceEqual(var_order, list(counter.columns))
+    
+    def test_chunks(self):
+        _vars = {'a':range(7), 'b':list('xyz'), 'c':[True, False]}
+        chunks = list(iter_counterbalance(_vars, order=['c', 'a', 'b'], 
+                                          chunksize=10))
+        self.assertEqual([len(chunk) for chunk in chunks], [10, 10, 10, 10, 2])
+        self.assertTrue(pd.concat(chunks).equals(
+            counterbalance(_vars, order=['c', 'a', 'b'])))
+    
+    def test_exclude(self):
+        _vars = {'a':range(4), 'b':list('xyz'), 'c':[True, False]}
+        counter = counterbalance(_vars)
+        excluded = counterbalance(_vars, exclude=[{'a':[0, 1], 'b':'x'}, 
+                                                  lambda frame: frame['c']])
+        expected = counter[~(counter['a'].isin([0, 1]) & (counter['b'] == 'x')) 
+                           & ~counter['c']]
+        self.assertTrue(excluded.equals(expected.reset_index(drop=True)))
+        
+        chunks = iter_counterbalance(_vars, chunksize=5, 
+                                     exclude=[{'a':[0, 1], 'b':'x'}])
+        self.assertEqual(sum(len(chunk) for chunk in chunks), 24 - 4)
+        self.assertRaises(ValueError, counterbalance, _vars, 
+                          exclude=[{'d':1}])
+    
+    def test_categorical(self):
+        _vars = {'a':range(4), 'b':list('xyz')}
+        counter = counterbalance(_vars, categorical=True)
+        self.assertTrue((counter.dtypes == 'category').all())
+        self.assertEqual(list(counter['b'].cat.categories), list('xyz'))
+        self.assertTrue(counter.astype(object).equals(
+            counterbalance(_vars).astype(object)))
+        
+        extended = extend(expand(counter, 'valid', ratio=0.75), reps=2)
+        self.assertTrue((extended[['a', 'b']].dtypes == 'category').all())
+        
+        for values in [[1, 1, 2], [1, np.nan]]:
+            self.assertEqual(len(counterbalance({'a':values})), len(values))
+            self.assertRaises(ValueError, counterbalance, {'a':values}, 
+                              categorical=True)
+    
+    def test_unrank(self):
+        _vars = {'a':range(7), 'b':list('xyz'), 'c':[True, False]}
+        counter = counterbalance(_vars)
+        self.assertEqual(unrank_counterbalance(_vars, 17), 
+                         dict(counter.loc[17]))
+        cells = unrank_counterbalance(_vars, [40, 3, 17])
+        self.assertTrue(cells.equals(counter.loc[[40, 3, 17]]))
+        self.assertRaises(ValueError, unrank_counterbalance, _vars, 42)
+        
+        cell = unrank_counterbalance({'a':[1, 2], 'b':[0.5, 1.5]}, 3)
+        self.assertEqual(cell, {'a':2, 'b':1.5})
+        self.assertTrue(type(cell['a']) is int)
+        self.assertTrue(type(cell['b']) is float)
+    
+    def test_sample(self):
+        _vars = {'a':range(1000), 'b':range(1000), 'c':range(1000)}
+        sampled = sample_counterbalance(_vars, 500, seed=100)
+        self.assertEqual(len(sampled), 500)
+        self.assertTrue(sampled.index.is_unique)
+        self.assertTrue(sampled.equals(unrank_counterbalance(_vars, 
+                                                             sampled.index)))
+        self.assertTrue(sampled.equals(sample_counterbalance(_vars, 500, 
+                                                             seed=100)))
+
+class OrderTests(unittest.TestCase):
+    def count_pairs(self, orders):
+        pairs = {}
+        for order in orders:
+            for pair in zip(order[:-1], order[1:]):
+                pairs[pair] = pairs.get(pair, 0) + 1
+        return pairs
+    
+    def test_williams_square(self):
+        for num_conditions, num_rows in [(4, 4), (5, 10)]:
+            square = williams_square(num_conditions)
+            self.assertEqual(square.shape, (num_rows, num_conditions))
+            for position in square.columns:
+                counts = square[position].value_counts()
+                self.assertEqual(len(counts), num_conditions)
+                self.assertEqual(counts.min(), counts.max())
+            pairs = self.count_pairs(square.values.tolist())
+            self.assertEqual(len(pairs), num_conditions*(num_conditions - 1))
+            self.assertEqual(len(set(pairs.values())), 1)
+    
+    def test_williams_order(self):
+        square = williams_square(list('abcde'))
+        for participant in range(12):
+            self.assertEqual(williams_order(list('abcde'), participant),
+                             list(square.loc[participant % 10]))
+    
+    def test_carryover_sequence(self):
+        sequence = carryover_sequence(list('abcd'), start=5)
+        self.assertEqual(len(sequence), 17)
+        pairs = self.count_pairs([sequence])
+        self.assertEqual(len(pairs), 16)
+        self.assertEqual(set(pairs.values()), set([1]))
 
 class ExpandTests(unittest.TestCase):
+    def setUp(self):
+        self.trials = pd.DataFrame({'ix':range(10)})
+    
     def test_sample(self):
-        pass
+        expanded = expand(self.trials, 'valid', ratio=0.6, sample=True, 
+                          seed=100)
+        self.assertEqual(list(expanded['valid']), [1]*10 + [0]*7)
+        invalid = expanded.loc[expanded['valid'] == 0, 'ix']
+        self.assertTrue(invalid.is_unique)
     
     def test_copy(self):
-        pass
+        expanded = expand(self.trials, 'valid', ratio=0.75)
+        self.assertEqual(list(expanded.columns), ['valid', 'ix'])
+        self.assertEqual(list(expanded['valid']), [1]*30 + [0]*10)
+        self.assertEqual(list(expanded['ix']), range(10)*4)
     
     def test_seed(self):
-        pass
+        first = expand(self.trials, 'valid', sample=True, ratio=0.7, seed=100)
+        second = expand(self.trials, 'valid', sample=True, ratio=0.7, seed=100)
+        self.assertTrue(first.equals(second))
+    
+    def test_weights(self):
+        expanded = expand(self.trials, 'resp', values=list('abc'), 
+                          ratio=[3, 2, 1])
+        self.assertEqual(list(expanded['resp']), 
+                         ['a']*30 + ['b']*20 + ['c']*10)
+        self.assertRaises(ValueError, expand, self.trials, 'resp', 
+                          values=list('abc'), ratio=0.5)
+    
+    def test_small_weights(self):
+        expanded = expand(self.trials, 'valid', ratio=0.25)
+        self.assertEqual(list(expanded['valid']), [1]*10 + [0]*30)
+        self.assertTrue(expanded.equals(expand(self.trials, 'valid', 
+                                               ratio=[1, 3])))
+        expanded = expand(self.trials, 'resp', values=list('abc'), 
+                          ratio=[1, 1, 4])
+        self.assertEqual(list(expanded['resp']), 
+                         ['a']*10 + ['b']*10 + ['c']*40)
+        self.assertRaises(ValueError, expand, self.trials, 'valid', 
+                          ratio=0.99, sample=True)
 
 class ExtendTests(unittest.TestCase):
     def setUp(self):
@@ -72,6 +204,181 @@ class ExtendTests(unittest.TestCase):
         self.assertTrue(('id' in ext.columns and \
                          len(ext.columns) == len(self.trials.columns)+1))
 
+class AddBlockTests(unittest.TestCase):
+    def setUp(self):
+        self.trials = pd.DataFrame({'id':list('abcd')*6, 'ix':range(24)})
+    
+    def test_add_block(self):
+        blocked = add_block(self.trials, 6, start_at=1, seed=100)
+        self.assertEqual(list(blocked['block']), sorted(range(1, 5)*6))
+        self.assertItemsEqual(blocked['ix'], self.trials['ix'])
+    
+    def test_id_col(self):
+        blocked = add_block(self.trials, 4, id_col='id', seed=100)
+        counts = blocked.groupby(['block', 'id']).size()
+        self.assertEqual(counts.max(), 1)
+        self.assertEqual(blocked['block'].value_counts().max(), 4)
+    
+    def test_seed(self):
+        first = add_block(self.trials, 4, id_col='id', seed=100)
+        second = add_block(self.trials, 4, id_col='id', seed=100)
+        self.assertTrue(first.equals(second))
+    
+    def test_strata(self):
+        trials = pd.DataFrame({'cond':list('ab')*30, 'resp':list('xyz')*20,
+                               'ix':range(60)})
+        blocked = add_block(trials, 12, id_col=['cond', 'resp'], seed=100)
+        counts = blocked.groupby(['block', 'cond', 'resp']).size()
+        self.assertEqual(len(counts), 5*6)
+        self.assertTrue(counts.max() - counts.min() <= 1)
+        self.assertTrue((blocked['block'].value_counts() == 12).all())
+
+class SimpleShuffleTests(unittest.TestCase):
+    def setUp(self):
+        self.trials = pd.DataFrame({'block':[1, 0]*10, 'ix':range(20)})
+    
+    def test_shuffle(self):
+        shuffled = simple_shuffle(self.trials, seed=100)
+        self.assertItemsEqual(shuffled['ix'], self.trials['ix'])
+        self.assertTrue(shuffled.equals(simple_shuffle(self.trials, 
+                                                       seed=100)))
+    
+    def test_block(self):
+        shuffled = simple_shuffle(self.trials, block='block', seed=100)
+        self.assertEqual(list(shuffled['block']), [0]*10 + [1]*10)
+        self.assertItemsEqual(shuffled['ix'], self.trials['ix'])
+        self.assertEqual(list(shuffled.index.get_level_values(1)), 
+                         list(shuffled['ix']))
+
+class MinRepeatsTests(unittest.TestCase):
+    def test_feasible(self):
+        self.assertEqual(min_repeats(list('aabbcc')), 0)
+        self.assertEqual(min_repeats(list('aaabb')), 0)
+    
+    def test_infeasible(self):
+        self.assertEqual(min_repeats(list('aaaab')), 2)
+        self.assertEqual(min_repeats(list('aaaab'), max_run=2), 0)
+    
+    def test_lag(self):
+        self.assertEqual(min_repeats(list('aabbcc'), min_lag=2), 0)
+        self.assertTrue(min_repeats(list('aabbcc'), min_lag=3) > 0)
+
+class SmartShuffleTests(unittest.TestCase):
+    def setUp(self):
+        values = ['a']*40 + ['b']*30 + ['c']*20 + ['d']*10
+        self.trials = pd.DataFrame({'x':values, 'ix':range(len(values))})
+    
+    def count_repeats(self, trials):
+        x = trials['x'].values
+        return (x[1:] == x[:-1]).sum()
+    
+    def test_greedy(self):
+        shuffled = smart_shuffle(self.trials, 'x', seed=100, method='greedy')
+        self.assertEqual(self.count_repeats(shuffled), 0)
+        self.assertItemsEqual(shuffled['ix'], self.trials['ix'])
+    
+    def test_greedy_infeasible(self):
+        self.trials['x'] = ['a']*70 + ['b']*30
+        shuffled = smart_shuffle(self.trials, 'x', seed=100, method='greedy')
+        self.assertEqual(self.count_repeats(shuffled), 70 - 30 - 1)
+    
+    def test_batch(self):
+        trials = pd.DataFrame({'x':list('abcd')*5, 'ix':range(20)})
+        shuffled = smart_shuffle(trials, 'x', seed=100, method='batch')
+        self.assertEqual(self.count_repeats(shuffled), 0)
+        self.assertItemsEqual(shuffled['ix'], range(20))
+    
+    def test_swap(self):
+        shuffled = smart_shuffle(self.trials, 'x', seed=100, method='swap')
+        self.assertEqual(self.count_repeats(shuffled), 0)
+        self.assertItemsEqual(shuffled['ix'], self.trials['ix'])
+    
+    def test_stop_at_bound(self):
+        self.trials['x'] = ['a']*70 + ['b']*30
+        shuffled, report = smart_shuffle(self.trials, 'x', seed=100, 
+                                         method='swap', lim=100000, 
+                                         report=True)
+        self.assertEqual(report['bound'][None], 39)
+        self.assertEqual(self.count_repeats(shuffled), 39)
+        self.assertTrue(report['iterations'][None] < 100000)
+    
+    def test_time_budget(self):
+        self.trials['block'] = [0, 1]*50
+        shuffled, report = smart_shuffle(self.trials, 'x', block='block', 
+                                         seed=100, time_budget=0.05, 
+                                         report=True)
+        self.assertItemsEqual(report.index, [0, 1])
+        self.assertTrue((report['iterations'] > 0).all())
+        self.assertTrue((report['seconds'] < 0.5).all())
+        for key, chunk in shuffled.groupby('block'):
+            self.assertEqual(self.count_repeats(chunk), report['repeats'][key])
+    
+    def test_empty(self):
+        shuffled, report = smart_shuffle(self.trials[:0], 'x', block='x',
+                                         time_budget=1.0, report=True)
+        self.assertEqual(len(shuffled), 0)
+        self.assertEqual(len(report), 0)
+    
+    def test_block_list(self):
+        self.trials['b'] = [0, 1]*50
+        self.trials['c'] = [0]*50 + [1]*50
+        shuffled, report = smart_shuffle(self.trials, 'x', block=['b', 'c'],
+                                         seed=100, report=True)
+        self.assertEqual(list(report.index.names), ['b', 'c'])
+        self.assertEqual(len(report), 4)
+        for key, chunk in shuffled.groupby(['b', 'c']):
+            self.assertEqual(self.count_repeats(chunk), 
+                             report['repeats'][key])
+        first = smart_shuffle(self.trials, 'x', block=['b'], seed=100)
+        second = smart_shuffle(self.trials, 'x', block='b', seed=100)
+        self.assertTrue(first.equals(second))
+    
+    def test_rules(self):
+        trials = pd.DataFrame({'resp':['l']*60 + ['r']*40,
+                               'item':range(20)*5})
+        rules = {'resp':{'max_run':3}, 'item':{'min_lag':5}}
+        shuffled = smart_shuffle(trials, rules, seed=100)
+        
+        resp = shuffled['resp'].values
+        runs = np.concatenate([[0], (resp[1:] != resp[:-1]).cumsum()])
+        self.assertTrue(pd.Series(runs).value_counts().max() <= 3)
+        
+        last_seen = shuffled.reset_index(drop=True).groupby('item').apply(
+            lambda grp: np.diff(grp.index.values).min())
+        self.assertTrue((last_seen > 5).all())
+        self.assertItemsEqual(shuffled['item'], trials['item'])
+    
+    def test_missing(self):
+        trials = pd.DataFrame({'x':[np.nan]*6 + ['a', 'a', 'b', 'b'],
+                               'ix':range(10)})
+        for method in ['sample', 'batch', 'swap', 'greedy']:
+            shuffled, report = smart_shuffle(trials, 'x', seed=100, 
+                                             method=method, report=True)
+            self.assertEqual(report['repeats'][None], 0)
+            self.assertItemsEqual(shuffled['ix'], trials['ix'])
+        shuffled, report = smart_shuffle(trials, {'x':{'min_lag':1}}, 
+                                         seed=100, report=True)
+        self.assertEqual(report['repeats'][None], 0)
+    
+    def test_greedy_seed(self):
+        first = smart_shuffle(self.trials, 'x', seed=100, method='greedy')
+        second = smart_shuffle(self.trials, 'x', seed=100, method='greedy')
+        self.assertTrue(first.equals(second))
+    
+    def test_n_jobs(self):
+        first, report = smart_shuffle(self.trials, 'x', seed=100, n_jobs=2,
+                                      report=True)
+        second = smart_shuffle(self.trials, 'x', seed=100, n_jobs=2)
+        self.assertTrue(first.equals(second))
+        self.assertEqual(self.count_repeats(first), report['repeats'][None])
+        self.assertItemsEqual(first['ix'], self.trials['ix'])
+    
+    def test_n_jobs_swap(self):
+        # rounds continue each worker's search instead of restarting it
+        shuffled = smart_shuffle(self.trials, 'x', seed=100, method='swap',
+                                 lim=1000, n_jobs=2)
+        self.assertEqual(self.count_repeats(shuffled), 0)
+
 def main():
     unittest.main()
 
@@ -2,12 +2,21 @@
 """
 labtools.trials_functions
 """
+import heapq
 import pandas as pd
+import numpy as np
 
+from math import exp
+from time import time
 from numpy.random import RandomState
-from itertools import product
+from multiprocessing import Pool
 
-def counterbalance(conditions, order=None):
+__all__ = ['counterbalance', 'iter_counterbalance', 'unrank_counterbalance',
+           'sample_counterbalance', 'williams_square', 'williams_order',
+           'carryover_sequence', 'expand', 'extend', 'add_block', 
+           'simple_shuffle', 'min_repeats', 'smart_shuffle']
+
+def counterbalance(conditions, order=None, exclude=None, categorical=False):
     """
     Generate all independent variable combinations in a DataFrame.
     
@@ -19,22 +28,359 @@ def counterbalance(conditions, order=None):
         of length 1.
     :param order: Optional order of columns in output.
     :type order: list or None
+    :param exclude: Combinations to leave out. Each rule is either a dict of
+        variable names and forbidden values, which excludes combinations 
+        matching every entry, or a function taking a DataFrame of 
+        combinations and returning True for the rows to exclude.
+    :type exclude: list or None
+    :param bool categorical: Should each variable be a categorical column 
+        with its values as categories, in the order given? Saves memory and
+        speeds up grouping in large designs. The values of each variable 
+        must then be unique and not missing. Defaults to False.
     :return: Each row is a unique combination of input variables, assuming the 
         possible values for each variable are unique.
     :rtype: pandas.DataFrame
     """
-    for k,v in conditions.items():
-        if not hasattr(v, '__iter__'):
-            conditions[k] = [v]
+    names, levels = _condition_levels(conditions)
+    num_combinations = _num_combinations(levels)
+    
+    if categorical:
+        _check_categories(names, levels)
     
-    combinations = list(product(*conditions.values()))
-    frame = pd.DataFrame(combinations, columns=conditions.keys())
+    frame = _decode_combinations(names, levels, np.arange(num_combinations),
+                                 exclude, categorical)
+    frame.index = pd.RangeIndex(len(frame))
     
     if order is None:
         order = frame.columns
     
     return frame[order]
+
+def iter_counterbalance(conditions, order=None, chunksize=100000, 
+                        exclude=None, categorical=False):
+    """
+    Generate all independent variable combinations in chunks.
+    
+    Yields the rows of :func:`counterbalance` in the same order, so that 
+    designs too large to hold in memory can be processed piece by piece. 
+    Memory use depends on `chunksize` rather than the size of the design.
+    
+    :param dict conditions: Variable names and possible values. Values can be
+        of length 1.
+    :param order: Optional order of columns in output.
+    :type order: list or None
+    :param int chunksize: Maximum number of rows in each chunk. Defaults to
+        100000.
+    :param exclude: Combinations to leave out, as in :func:`counterbalance`.
+        Chunks are built from `chunksize` rows of the full design, so they 
+        can be shorter with exclusions, and empty chunks are skipped.
+    :type exclude: list or None
+    :param bool categorical: Should each variable be a categorical column, 
+        as in :func:`counterbalance`? Every chunk has the same categories.
+        Defaults to False.
+    :return: Chunks of combinations, indexed by their row in the full design.
+    :rtype: generator of pandas.DataFrame
+    """
+    names, levels = _condition_levels(conditions)
+    num_combinations = _num_combinations(levels)
+    if categorical:
+        _check_categories(names, levels)
+    
+    for start in xrange(0, num_combinations, chunksize):
+        stop = min(start + chunksize, num_combinations)
+        frame = _decode_combinations(names, levels, np.arange(start, stop),
+                                     exclude, categorical)
+        if len(frame):
+            yield frame if order is None else frame[order]
+
+def unrank_counterbalance(conditions, ranks, order=None):
+    """
+    Look up combinations by their row in :func:`counterbalance`.
+    
+    Only the requested combinations are built, so single cells of very large
+    designs cost no more than small ones.
+    
+    :param dict conditions: Variable names and possible values. Values can be
+        of length 1.
+    :param ranks: Row or rows of the full design.
+    :type ranks: int or list-like of int
+    :param order: Optional order of columns in output.
+    :type order: list or None
+    :return: The combination as a dict for a single rank, or a DataFrame 
+        indexed by rank otherwise.
+    :rtype: dict or pandas.DataFrame
+    """
+    names, levels = _condition_levels(conditions)
+    num_combinations = _num_combinations(levels)
+    
+    single = np.ndim(ranks) == 0
+    ranks = np.atleast_1d(np.asarray(ranks, dtype=np.int64))
+    if ((ranks < 0) | (ranks >= num_combinations)).any():
+        raise ValueError('ranks must be between 0 and %d' % 
+                         (num_combinations - 1))
+    
+    if single:
+        # look up the given values directly to keep their types
+        rank, combination = int(ranks[0]), {}
+        for name in reversed(names):
+            values = conditions[name]
+            if not hasattr(values, '__iter__'):
+                values = [values]
+            values = list(values)
+            rank, code = divmod(rank, len(values))
+            combination[name] = values[code]
+        if order is not None:
+            combination = dict((name, combination[name]) for name in order)
+        return combination
+    
+    frame = _decode_combinations(names, levels, ranks)
+    return frame if order is None else frame[order]
+
+def sample_counterbalance(conditions, size, order=None, seed=None):
+    """
+    Sample combinations from :func:`counterbalance` without replacement.
+    
+    Ranks are drawn at random and repeats are redrawn, so the cost depends on
+    `size` rather than the size of the design unless most of the design is 
+    sampled.
+    
+    :param dict conditions: Variable names and possible values. Values can be
+        of length 1.
+    :param int size: Number of combinations to sample.
+    :param order: Optional order of columns in output.
+    :type order: list or None
+    :param seed: Seed random number generator.
+    :type seed: int or None
+    :return: Sampled combinations in random order, indexed by rank.
+    :rtype: pandas.DataFrame
+    """
+    names, levels = _condition_levels(conditions)
+    num_combinations = _num_combinations(levels)
+    if size > num_combinations:
+        raise ValueError('cannot sample %d of %d combinations' % 
+                         (size, num_combinations))
+    
+    prng = RandomState(seed)
+    if 2 * size > num_combinations:
+        ranks = prng.permutation(num_combinations)[:size]
+    else:
+        ranks = np.empty(0, dtype=np.int64)
+        while len(ranks) < size:
+            drawn = prng.randint(0, num_combinations, size - len(ranks), 
+                                 dtype=np.int64)
+            ranks = np.concatenate([ranks, drawn])
+            first = np.unique(ranks, return_index=True)[1]
+            ranks = ranks[np.sort(first)]
+    
+    frame = _decode_combinations(names, levels, ranks)
+    return frame if order is None else frame[order]
+
+def _condition_levels(conditions):
+    """
+    Split a dict of conditions into variable names and arrays of values.
+    Single values are treated as variables with one value.
+    """
+    names, levels = [], []
+    for name, values in conditions.items():
+        if not hasattr(values, '__iter__'):
+            values = [values]
+        names.append(name)
+        levels.append(pd.Series(list(values)).values)
+    return names, levels
+
+def _check_categories(names, levels):
+    """
+    Make sure the values of each variable can be used as categories.
+    """
+    for name, values in zip(names, levels):
+        values = pd.Series(values)
+        if values.isnull().any():
+            raise ValueError('values of %r cannot be categories because some '
+                             'are missing' % (name,))
+        if values.duplicated().any():
+            raise ValueError('values of %r cannot be categories because they '
+                             'are not unique' % (name,))
+
+def _num_combinations(levels):
+    """
+    Count the combinations of levels without overflowing.
+    """
+    return reduce(lambda total, values: total * len(values), levels, 1)
+
+def _decode_combinations(names, levels, ranks, exclude=None, 
+                         categorical=False):
+    """
+    Build the combinations at the given ranks in the full cross product.
+    
+    Ranks are decoded as mixed-radix numbers, with the last variable varying
+    fastest, in the same order as :func:`itertools.product`. Dict rules in 
+    `exclude` are checked on the integer codes as soon as their variables 
+    are decoded, so excluded combinations are dropped before any values are
+    looked up. Function rules are applied to the finished combinations.
+    
+    :param list names: Variable names.
+    :param list levels: Array of values for each variable.
+    :param numpy.ndarray ranks: Integer positions in the cross product.
+    :param exclude: Rules for combinations to leave out.
+    :type exclude: list or None
+    :param bool categorical: Should the columns be categorical?
+    :return: Combinations indexed by rank.
+    :rtype: pandas.DataFrame
+    """
+    rules, predicates = _exclusion_rules(names, levels, exclude or [])
+    
+    codes = {}
+    stride = 1
+    for j in reversed(range(len(names))):
+        radix = max(len(levels[j]), 1)
+        codes[j] = (ranks // stride) % radix
+        stride *= radix
+        
+        # rules are complete once their first variable is decoded
+        for rule in [rule for rule in rules if min(rule) == j]:
+            excluded = np.ones(len(ranks), dtype=bool)
+            for k, forbidden in rule.items():
+                excluded &= forbidden[codes[k]]
+            if excluded.any():
+                ranks = ranks[~excluded]
+                for k in codes:
+                    codes[k] = codes[k][~excluded]
     
+    if categorical:
+        columns = dict((names[j], pd.Categorical.from_codes(codes[j], 
+                                                            levels[j]))
+                       for j in codes)
+    else:
+        columns = dict((names[j], levels[j].take(codes[j])) for j in codes)
+    frame = pd.DataFrame(columns, index=pd.Index(ranks), columns=names)
+    
+    for predicate in predicates:
+        frame = frame[~np.asarray(predicate(frame), dtype=bool)]
+    return frame
+
+def _exclusion_rules(names, levels, exclude):
+    """
+    Split exclusion rules into functions and dicts of forbidden values. Dict
+    rules are converted to boolean arrays over the codes of each variable,
+    keyed by the position of the variable.
+    """
+    rules, predicates = [], []
+    for rule in exclude:
+        if callable(rule):
+            predicates.append(rule)
+            continue
+        
+        masks = {}
+        for name, values in rule.items():
+            if name not in names:
+                raise ValueError('unknown variable %r in exclude' % (name,))
+            if not hasattr(values, '__iter__'):
+                values = [values]
+            j = names.index(name)
+            masks[j] = pd.Series(levels[j]).isin(list(values)).values
+        if masks:
+            rules.append(masks)
+    return rules, predicates
+    
+def williams_square(conditions):
+    """
+    Build a Williams design balanced Latin square of condition orders.
+    
+    Each condition appears once in every position, and each condition is
+    immediately followed by every other condition equally often. Squares 
+    for an odd number of conditions need twice as many rows, and the extra
+    rows are the first rows reversed.
+    
+    :param conditions: Number of conditions or a list of condition labels.
+    :type conditions: int or list
+    :return: One row per order, with a column for each position.
+    :rtype: pandas.DataFrame
+    """
+    labels = _order_labels(conditions)
+    num_rows = _williams_rows(len(labels))
+    orders = [_williams_order(len(labels), row) for row in xrange(num_rows)]
+    return pd.DataFrame(labels.take(np.array(orders, dtype=int)))
+
+def williams_order(conditions, participant):
+    """
+    Look up the condition order for one participant in a Williams design.
+    
+    Participants cycle through the rows of :func:`williams_square`, so each 
+    complete set of rows is balanced. The order is computed directly in 
+    O(n) without building the square.
+    
+    :param conditions: Number of conditions or a list of condition labels.
+    :type conditions: int or list
+    :param int participant: Participant number, starting at 0.
+    :return: Conditions in the order they should be run.
+    :rtype: list
+    """
+    labels = _order_labels(conditions)
+    row = participant % _williams_rows(len(labels))
+    return labels.take(_williams_order(len(labels), row)).tolist()
+
+def carryover_sequence(conditions, start=0):
+    """
+    Build a sequence in which every condition follows every condition, 
+    itself included, exactly once.
+    
+    The sequence is a de Bruijn sequence of order 2, of length ``n**2 + 1``
+    for `n` conditions. Because the underlying cycle is balanced from any 
+    point, participants can be given different sequences by varying 
+    `start`.
+    
+    :param conditions: Number of conditions or a list of condition labels.
+    :type conditions: int or list
+    :param int start: Position in the cycle to start from, e.g. the 
+        participant number. Defaults to 0.
+    :return: Conditions in the order they should be run.
+    :rtype: list
+    """
+    labels = _order_labels(conditions)
+    num_conditions = len(labels)
+    
+    # concatenate the Lyndon words of length 1 and 2 in lexicographic order
+    cycle = []
+    for first in xrange(num_conditions):
+        cycle.append(first)
+        for second in xrange(first + 1, num_conditions):
+            cycle.extend([first, second])
+    
+    positions = (start + np.arange(len(cycle) + 1)) % max(len(cycle), 1)
+    return labels.take(np.array(cycle, dtype=int)[positions]).tolist()
+
+def _order_labels(conditions):
+    """
+    Convert a number of conditions or a list of condition labels to an
+    array of labels.
+    """
+    if isinstance(conditions, (int, long, np.integer)):
+        conditions = range(conditions)
+    labels = pd.Series(list(conditions)).values
+    if len(labels) == 0:
+        raise ValueError('at least one condition is required')
+    return labels
+
+def _williams_rows(num_conditions):
+    """
+    Number of rows in a Williams square.
+    """
+    return num_conditions if num_conditions % 2 == 0 else 2 * num_conditions
+
+def _williams_order(num_conditions, row):
+    """
+    Compute one row of a Williams square as positions of the conditions.
+    
+    The first row is 0, 1, n-1, 2, n-2, ... and row k adds k to each 
+    position, modulo n. For odd n, rows n to 2n-1 are rows 0 to n-1 
+    reversed.
+    """
+    steps = np.arange(num_conditions)
+    first = np.where(steps % 2, (steps + 1) // 2, 
+                     (num_conditions - steps // 2) % num_conditions)
+    order = (first + row) % num_conditions
+    return order[::-1] if row >= num_conditions else order
+
 def expand(valid, name, values=[1,0], ratio=0.5, sample=False, seed=None):
     """
     Copy rows as necessary to satisfy the valid:invalid ratio.
@@ -43,11 +389,22 @@ def expand(valid, name, values=[1,0], ratio=0.5, sample=False, seed=None):
     ratio of trials requiring response A to those requiring response B is not
     50:50.
     
+    More than two values can be given with a weight for each. Without 
+    `sample`, each value gets whole copies of the trials in proportion to 
+    its weight relative to the smallest weight, so every value gets at
+    least one copy. With `sample`, the first value 
+    gets the trials once and the others get trials sampled from them. Counts
+    that do not divide evenly are rounded so that the total is as close as 
+    possible to the requested proportions, with leftovers going to the 
+    values with the largest remainders.
+    
     :param pandas.DataFrame valid: Trial list to be expanded.
     :param str name: Name of new column containing valid and invalid values
     :param list values: Values for valid and invalid trials, respectively.
-    :param float ratio: Desired percentage of valid trials in the resulting 
-        frame. Must be between 0 and 1. Defaults to 0.5.
+    :param ratio: Desired percentage of valid trials in the resulting 
+        frame. Must be between 0 and 1. Defaults to 0.5. Can also be a list
+        of weights, one for each of `values`.
+    :type ratio: float or list
     :param bool sample: Should the invalid trials be sampled from the valid 
         trials? If True, len(returned) < 2*len(valid). Defaults to False.
     :param seed: Seed random number generator.
@@ -56,22 +413,54 @@ def expand(valid, name, values=[1,0], ratio=0.5, sample=False, seed=None):
         new column.
     :rtype: pandas.DataFrame
     """
+    if hasattr(ratio, '__iter__'):
+        weights = np.asarray(ratio, dtype=float)
+    else:
+        weights = np.array([ratio, 1.0 - ratio])
+    if len(weights) != len(values):
+        raise ValueError('expected a weight for each of %d values, got %d' % 
+                         (len(values), len(weights)))
+    if not (weights > 0).all():
+        raise ValueError('weights must be positive')
+    
     prng = RandomState(seed)
     num_trials = len(valid)
     
     if not sample:
-        invalid = valid[:]
-        num_valid = (num_trials*ratio)/(1.0-ratio)
-        copies = int(num_valid/num_trials)
-        valid = pd.concat([valid]*copies, ignore_index=True)
+        quotas = weights/weights.min()
+        copies = _allocate(quotas, int(round(quotas.sum())))
+        counts = copies * num_trials
+        positions = np.tile(np.arange(num_trials), copies.sum())
     else:
-        num_invalid = int((num_trials*(1.0-ratio))/ratio)
-        sampled = prng.choice(valid.index, num_invalid, replace=False)
-        invalid = valid.reindex(sampled).reset_index(drop=True)
+        quotas = num_trials * weights[1:]/weights[0]
+        counts = _allocate(quotas, int(round(quotas.sum())))
+        if num_trials and (counts == 0).any():
+            raise ValueError('weights too small to sample any trials for '
+                             'some values')
+        positions = [np.arange(num_trials)]
+        for count in counts:
+            positions.append(prng.choice(num_trials, count, replace=False))
+        counts = np.concatenate([[num_trials], counts])
+        positions = np.concatenate(positions)
     
-    frame = pd.concat([valid, invalid], keys=values, names=[name,'DEFAULT'])
-    frame = frame.reset_index().drop('DEFAULT', axis=1)
+    frame = valid.take(positions)
+    frame.index = pd.RangeIndex(len(frame))
+    frame.insert(0, name, pd.Series(list(values)).values.repeat(counts))
     return frame
+
+def _allocate(quotas, total):
+    """
+    Round quotas to integers summing to total by the largest remainder 
+    method. Ties go to the earlier quota.
+    """
+    # drop floating point noise such as 2.9999999999999996
+    quotas = np.round(quotas, 9)
+    counts = np.floor(quotas).astype(int)
+    leftover = total - counts.sum()
+    if leftover > 0:
+        largest = np.argsort(counts - quotas, kind='mergesort')[:leftover]
+        counts[largest] += 1
+    return counts
     
 def extend(frame, reps=None, max_length=None, rep_ix=None, row_ix=None):
     """
@@ -114,50 +503,69 @@ def add_block(frame, size, name='block', start_at=0, id_col=None, seed=None):
     """
     Creates a new column for block.
     
+    Block labels are dealt out in random order, using every block once 
+    before any block is used again, and the trials are sorted by block.
+    
+    With `id_col`, trials are stratified by the unique combinations of 
+    values in the columns. A single random order of the blocks is dealt out
+    round robin to the trials of each stratum in random order, continuing 
+    from where the previous stratum left off. Each block then gets the same
+    number of trials from every stratum, give or take one.
+    
     :param pandas.DataFrame frame: Trials to be assigned blocks.
     :param int size: Length of each block.
-    :param id_col: Column to group by before blocking. Assures that blocks 
-        consist of approximately the same number of trials for each unique
-        value in id_col
-    :type id_col: str or None
+    :param id_col: Column or columns to stratify by before blocking.
+    :type id_col: str, list, or None
     :param seed: Seed random number generator.
     :type seed: int or None
     :returns: Trial list with new column for block.
     :rtype: pandas.DataFrame
     """
-    def _assigner(blocks, prng):
-        prng.shuffle(blocks)
-        i = 0
-        while True:
-            yield blocks[i]
-            if (i+1)%len(blocks):
-                prng.shuffle(blocks)
-            i = (i+1)%len(blocks)
-            
-    prng = RandomState(seed)
-    blocks = range(len(frame)/size)
-    assigner = _assigner(blocks, prng)
+    num_blocks = len(frame)/size
+    if num_blocks == 0:
+        raise ValueError('size %d is larger than the number of trials' % size)
     
-    def _add(chunk):
-        chunk[name] = [assigner.next() for _ in xrange(len(chunk))]
-        return chunk
+    prng = RandomState(seed)
     
     if id_col is None:
-        new_frame = _add(frame).sort(name)
+        # one label stream, permuted anew each time every block has been used
+        num_cycles = -(-len(frame) // num_blocks)
+        labels = np.argsort(prng.random_sample((num_cycles, num_blocks)), 
+                            axis=1)
+        new_frame = frame.copy()
+        new_frame[name] = labels.ravel()[:len(frame)]
     else:
-        new_frame = frame.groupby(id_col).apply(_add).sort(name)
+        strata = frame.groupby(id_col, sort=True).ngroup().values
+        keep = strata >= 0
+        strata = strata[keep]
+        
+        # trials sorted by stratum, in random order within each stratum
+        order = np.lexsort((prng.random_sample(len(strata)), strata))
+        blocks = prng.permutation(num_blocks)
+        labels = np.empty(len(strata), dtype=blocks.dtype)
+        labels[order] = blocks[np.arange(len(strata)) % num_blocks]
+        
+        new_frame = frame[keep].copy()
+        new_frame[name] = labels
     
+    new_frame = new_frame.sort_values(name, kind='mergesort')
     new_frame[name] = new_frame[name] + start_at
     return new_frame
-                
+
 def simple_shuffle(frame, block=None, times=10, seed=None):
     """
-    Shuffles trials a few times.
+    Shuffles trials, optionally within blocks.
+    
+    Rows are ordered by a single uniform permutation. With `block`, rows are
+    sorted by block and shuffled within each block in one pass, and the
+    result is indexed by the block and the original index, as from a
+    groupby.
     
     :param pandas.DataFrame frame: Trials to be shuffled.
     :param block: Optional column to groupby before shuffling.
     :type block: str or None.
-    :param int times: Number of times to shuffle. Defaults to 10.
+    :param int times: Ignored. A single permutation is already uniform, so 
+        this is only kept for backwards compatibility.
     :param seed: Seed random number generator.
     :type seed: int or None
     :returns: Trial list with rows in random order.
@@ -165,53 +573,658 @@ def simple_shuffle(frame, block=None, times=10, seed=None):
     """
     prng = RandomState(seed)
     
-    def _shuffle(chunk):
-        for _ in range(times):
-            chunk = chunk.reindex(prng.permutation(chunk.index))
-        return chunk
-    
     if block is None:
-        return _shuffle(frame)
+        return frame.take(prng.permutation(len(frame)))
+    
+    codes = frame.groupby(block, sort=True).ngroup().values
+    order = np.lexsort((prng.random_sample(len(frame)), codes))
+    order = order[codes[order] >= 0]
+    shuffled = frame.take(order)
+    
+    blocks = [block] if isinstance(block, basestring) else list(block)
+    index = shuffled.index
+    shuffled.index = pd.MultiIndex.from_arrays(
+        [shuffled[b].values for b in blocks] + 
+        [index.get_level_values(i) for i in range(index.nlevels)],
+        names=blocks + list(index.names))
+    return shuffled
+
+def min_repeats(values, max_run=1, min_lag=0):
+    """
+    Computes a lower bound on the repeats left after any shuffle of values.
+    
+    A trial is counted as a repeat if it extends a run of identical values
+    past `max_run` trials, or if it comes within `min_lag` trials of the last
+    identical value. The bound only depends on how often each value occurs,
+    so it is found in O(n) without searching. A bound above 0 means the
+    constraints cannot be met by any order.
+    
+    For the default constraints, which forbid identical values back to back,
+    the bound is exact: with `m` copies of the most common of `n` values, no
+    order has fewer than ``max(0, 2*m - n - 1)`` repeats.
+    
+    :param values: Values to be shuffled.
+    :type values: pandas.Series, numpy.ndarray, or list
+    :param int max_run: Maximum length of a run of identical values. Use 0 to
+        leave runs unconstrained. Defaults to 1.
+    :param int min_lag: Minimum number of other trials between identical 
+        values. Defaults to 0.
+    :return: Minimum number of repeats.
+    :rtype: int
+    """
+    codes = pd.factorize(values)[0]
+    counts = np.bincount(codes[codes >= 0])
+    num_values = len(codes)
+    if len(counts) == 0:
+        return 0
+    
+    bound = 0
+    if max_run:
+        # every run of a value must be broken up by at least one other value
+        separators = num_values - counts + 1
+        bound = np.maximum(counts - max_run * separators, 0).sum()
+    
+    if min_lag:
+        # a value fits at most once in every min_lag+1 trials
+        spacing = min_lag + 1
+        fits = -(-num_values // spacing)
+        lag_bound = np.maximum(counts - fits, 0).sum()
+        most = counts.max()
+        if (most - 1) * spacing + (counts == most).sum() > num_values:
+            lag_bound = max(lag_bound, 1)
+        bound = max(bound, lag_bound)
+    
+    return int(bound)
+
+def _count_repeats(codes):
+    """
+    Counts the values in a sequence that are the same as the previous value.
+    """
+    return (codes[1:] == codes[:-1]).sum()
+
+def _place_codes(codes, sequence, prng):
+    """
+    Picks rows to fill a sequence of values.
+    
+    Each value in `sequence` is filled with a row that has that value in
+    `codes`. Rows with the same value are used in random order.
+    
+    :param numpy.ndarray codes: Integer value of each row.
+    :param numpy.ndarray sequence: Desired integer values, a reordering of
+        `codes`.
+    :param numpy.random.RandomState prng: Randomizer.
+    :return: Positions of the rows in the desired order.
+    :rtype: numpy.ndarray
+    """
+    rows = np.lexsort((prng.random_sample(len(codes)), codes))
+    counts = np.bincount(codes)
+    starts = np.cumsum(counts) - counts
+    
+    # occurrence of each value in the sequence (groupby.cumcount)
+    by_value = np.argsort(sequence, kind='mergesort')
+    occurrence = np.empty(len(sequence), dtype=int)
+    occurrence[by_value] = np.arange(len(sequence)) - \
+        np.repeat(starts, counts)
+    
+    return rows[starts[sequence] + occurrence]
+
+def _greedy_order(codes, prng):
+    """
+    Orders values so that no value appears twice in a row, if possible.
+    
+    Each step takes the most frequent remaining value other than the one just
+    placed, breaking ties at random. This avoids every repeat whenever the
+    most frequent value makes up no more than half of the sequence, rounding
+    up. Any leftover copies of the most frequent value are placed at the end.
+    Runs in O(n log k) for n values with k unique values.
+    
+    :param numpy.ndarray codes: Integer value of each row.
+    :param numpy.random.RandomState prng: Randomizer.
+    :return: Positions of the rows in the new order.
+    :rtype: numpy.ndarray
+    """
+    counts = np.bincount(codes)
+    heap = [(-count, prng.random_sample(), code) 
+            for code, count in enumerate(counts) if count]
+    heapq.heapify(heap)
+    
+    sequence = []
+    held = None
+    while heap:
+        neg_count, _, code = heapq.heappop(heap)
+        sequence.append(code)
+        if held is not None:
+            heapq.heappush(heap, held)
+        held = None
+        if neg_count + 1 < 0:
+            held = (neg_count + 1, prng.random_sample(), code)
+    
+    if held is not None:
+        sequence.extend([held[2]] * -held[0])
+    
+    order = _place_codes(codes, np.array(sequence, dtype=int), prng)
+    return order, _count_repeats(codes[order]), 1
+
+def _keep_searching(tried, lim, deadline):
+    """
+    Checks whether a search has tried fewer than `lim` times or, if a
+    `deadline` is given, whether the deadline has not passed yet.
+    """
+    if deadline is None:
+        return tried < lim
+    return time() < deadline
+
+def _sample_order(codes, prng, lim, deadline=None, target=0):
+    """
+    Tries random orders, keeping the one with the fewest repeats.
+    
+    :param numpy.ndarray codes: Integer value of each row.
+    :param numpy.random.RandomState prng: Randomizer.
+    :param int lim: Maximum number of orders to try.
+    :param deadline: Optional time at which to stop instead of `lim`, as
+        returned by :func:`time.time`.
+    :type deadline: float or None
+    :param int target: Stop once no more than this many repeats are left,
+        e.g., the bound from :func:`min_repeats`.
+    :return: Positions of the rows in the best order, the number of repeats
+        in that order, and the number of orders tried.
+    :rtype: tuple
+    """
+    order = np.arange(len(codes))
+    repeats = None
+    tried = 0
+    while repeats is None or (repeats > target and 
+                              _keep_searching(tried, lim, deadline)):
+        new = order[prng.permutation(len(codes))]
+        r = _count_repeats(codes[new])
+        tried += 1
+        if repeats is None or r < repeats:
+            repeats = r
+            order = new
+    return order, repeats, tried
+
+def _batch_order(codes, prng, lim, batch_size, deadline=None, target=0):
+    """
+    Tries random orders in batches, keeping the one with the fewest repeats.
+    
+    Each batch is a matrix of permutations, drawn by sorting random keys, and
+    the repeats in every permutation of the batch are counted at once.
+    
+    :param numpy.ndarray codes: Integer value of each row.
+    :param numpy.random.RandomState prng: Randomizer.
+    :param int lim: Maximum number of orders to try.
+    :param int batch_size: Number of orders to try at once.
+    :param deadline: Optional time at which to stop instead of `lim`, as
+        returned by :func:`time.time`.
+    :type deadline: float or None
+    :param int target: Stop once no more than this many repeats are left,
+        e.g., the bound from :func:`min_repeats`.
+    :return: Positions of the rows in the best order, the number of repeats
+        in that order, and the number of orders tried.
+    :rtype: tuple
+    """
+    order = np.arange(len(codes))
+    repeats = None
+    tried = 0
+    while repeats is None or (repeats > target and 
+                              _keep_searching(tried, lim, deadline)):
+        num_orders = batch_size
+        if deadline is None:
+            num_orders = min(batch_size, lim - tried)
+        orders = prng.random_sample((num_orders, len(codes))).argsort(axis=1)
+        values = codes[orders]
+        r = (values[:, 1:] == values[:, :-1]).sum(axis=1)
+        best = r.argmin()
+        tried += num_orders
+        if repeats is None or r[best] < repeats:
+            repeats = r[best]
+            order = orders[best]
+    return order, repeats, tried
+
+def _swap_order(codes, prng, lim, deadline=None, target=0, 
+                temperature=0.1, initial=None):
+    """
+    Removes repeats from a random order by swapping pairs of rows.
+    
+    Starting from a random order, each step picks a row involved in a repeat
+    and a random partner, and swaps them if doing so does not add repeats.
+    Swaps that add repeats are accepted with a probability that falls over
+    time (simulated annealing) to escape local minima. Only the pairs next to
+    the two swapped rows can change, so each step updates the number of
+    repeats in constant time.
+    
+    :param numpy.ndarray codes: Integer value of each row.
+    :param numpy.random.RandomState prng: Randomizer.
+    :param int lim: Maximum number of swaps to try.
+    :param deadline: Optional time at which to stop instead of `lim`, as
+        returned by :func:`time.time`.
+    :type deadline: float or None
+    :param int target: Stop once no more than this many repeats are left,
+        e.g., the bound from :func:`min_repeats`.
+    :param float temperature: Starting temperature for accepting swaps that
+        add repeats. Use 0 for pure min-conflicts search.
+    :param initial: Optional order to start from instead of a random one, 
+        e.g., the best order from an earlier search.
+    :type initial: numpy.ndarray or None
+    :return: Positions of the rows in the best order, the number of repeats
+        in that order, and the number of swaps tried.
+    :rtype: tuple
+    """
+    num_rows = len(codes)
+    if initial is None:
+        order = prng.permutation(num_rows).tolist()
+    else:
+        order = list(initial)
+    values = [codes[i] for i in order]
+    
+    # pairs (p, p+1) holding a repeat, kept in a list for random choice
+    conflicts = [p for p in xrange(num_rows - 1) if values[p] == values[p+1]]
+    where = dict((p, k) for k, p in enumerate(conflicts))
+    
+    def _remove(p):
+        k = where.pop(p)
+        last = conflicts.pop()
+        if last != p:
+            conflicts[k] = last
+            where[last] = k
+    
+    def _update(p):
+        is_repeat = values[p] == values[p+1]
+        if is_repeat and p not in where:
+            where[p] = len(conflicts)
+            conflicts.append(p)
+        elif not is_repeat and p in where:
+            _remove(p)
+    
+    best_repeats = len(conflicts)
+    best_order = list(order)
+    start = time()
+    steps = 0
+    while len(conflicts) > target and _keep_searching(steps, lim, deadline):
+        steps += 1
+        p = conflicts[prng.randint(len(conflicts))]
+        i = p + prng.randint(2)
+        j = prng.randint(num_rows)
+        if values[i] == values[j]:
+            continue
+        
+        pairs = set(q for q in (i-1, i, j-1, j) if 0 <= q < num_rows - 1)
+        before = sum(values[q] == values[q+1] for q in pairs)
+        values[i], values[j] = values[j], values[i]
+        after = sum(values[q] == values[q+1] for q in pairs)
+        
+        if after > before:
+            if deadline is None:
+                progress = float(steps) / lim
+            else:
+                progress = (time() - start) / max(deadline - start, 1e-9)
+            heat = temperature * (1.0 - progress)
+            if heat <= 0 or prng.random_sample() >= exp((before-after)/heat):
+                values[i], values[j] = values[j], values[i]
+                continue
+        
+        order[i], order[j] = order[j], order[i]
+        for q in pairs:
+            _update(q)
+        
+        if len(conflicts) < best_repeats:
+            best_repeats = len(conflicts)
+            best_order = list(order)
+    
+    return np.array(best_order, dtype=int), best_repeats, steps
+
+def _constrained_order(codes, rules, prng, lim, deadline=None, target=0, 
+                       tries=10):
+    """
+    Builds orders that follow run-length and lag rules on several columns.
+    
+    Rows with the same values in every column are interchangeable, so orders
+    are built over the unique combinations of values. Each order is built one
+    trial at a time. The current run length and the last position of every
+    value are tracked for each column, so checking whether a candidate breaks
+    a rule takes constant time. Candidates are drawn at random in proportion
+    to how many of them remain. If `tries` draws all break a rule, the
+    remaining combination that breaks the fewest rules is used. Orders are
+    built up to `lim` times, keeping the one with the fewest repeats.
+    
+    :param numpy.ndarray codes: Integer value of each row (rows) in each
+        constrained column (columns).
+    :param list rules: Pairs of (max_run, min_lag) for each column. See
+        :func:`min_repeats`.
+    :param numpy.random.RandomState prng: Randomizer.
+    :param int lim: Maximum number of orders to build.
+    :param deadline: Optional time at which to stop instead of `lim`, as
+        returned by :func:`time.time`.
+    :type deadline: float or None
+    :param int target: Stop once no more than this many repeats are left.
+    :param int tries: Number of random candidates to check for each trial.
+    :return: Positions of the rows in the best order, the number of trials
+        that break a rule in that order, and the number of orders built.
+    :rtype: tuple
+    """
+    num_rows = len(codes)
+    combos, combo_codes = np.unique(codes, axis=0, return_inverse=True)
+    combo_values = combos.tolist()
+    combo_counts = np.bincount(combo_codes, minlength=len(combos)).tolist()
+    num_values = (codes.max(axis=0) + 1).tolist() if num_rows else []
+    
+    def _broken(combo, t, last, run, last_seen):
+        broken = 0
+        for j, (max_run, min_lag) in enumerate(rules):
+            value = combo_values[combo][j]
+            if max_run and last[j] == value and run[j] >= max_run:
+                broken += 1
+            elif min_lag and t - last_seen[j][value] <= min_lag:
+                broken += 1
+        return broken
+    
+    def _build():
+        remaining = list(combo_counts)
+        pool = combo_codes.tolist()
+        stale = [0] * len(combo_values)
+        last = [None] * len(rules)
+        run = [0] * len(rules)
+        last_seen = [[-num_rows - 1] * n for n in num_values]
+        
+        sequence = []
+        repeats = 0
+        for t in xrange(num_rows):
+            combo = None
+            for _ in xrange(tries):
+                k = prng.randint(len(pool))
+                drawn = pool[k]
+                if stale[drawn]:
+                    # drop a pool entry already used by the fallback below
+                    stale[drawn] -= 1
+                    pool[k] = pool[-1]
+                    pool.pop()
+                    continue
+                if not _broken(drawn, t, last, run, last_seen):
+                    combo = drawn
+                    pool[k] = pool[-1]
+                    pool.pop()
+                    break
+            
+            if combo is None:
+                scores = [(_broken(c, t, last, run, last_seen), 
+                           prng.random_sample(), c)
+                          for c, count in enumerate(remaining) if count]
+                broken, _, combo = min(scores)
+                repeats += broken > 0
+                stale[combo] += 1
+            
+            remaining[combo] -= 1
+            sequence.append(combo)
+            for j, value in enumerate(combo_values[combo]):
+                run[j] = run[j] + 1 if last[j] == value else 1
+                last[j] = value
+                last_seen[j][value] = t
+        
+        return sequence, repeats
+    
+    best, repeats = None, None
+    tried = 0
+    while repeats is None or (repeats > target and 
+                              _keep_searching(tried, lim, deadline)):
+        sequence, r = _build()
+        tried += 1
+        if repeats is None or r < repeats:
+            best, repeats = sequence, r
+    
+    order = _place_codes(combo_codes, np.array(best, dtype=int), prng)
+    return order, repeats, tried
+
+def _shuffle_codes(codes, rules, method, prng, lim, batch_size, deadline, 
+                   target, initial=None):
+    """
+    Searches for an order of a block with the requested method.
+    
+    Blocks with rules other than no identical values back to back on a single
+    column are always ordered by :func:`_constrained_order`. See 
+    :func:`smart_shuffle` for the arguments. The ``'swap'`` method starts 
+    from `initial` if given.
+    
+    :return: Positions of the rows in the best order, the number of repeats
+        in that order, and the number of tries.
+    :rtype: tuple
+    """
+    if len(rules) > 1 or rules[0] != (1, 0):
+        return _constrained_order(codes, rules, prng, lim, deadline, target)
+    
+    codes = codes[:, 0]
+    if method == 'greedy':
+        return _greedy_order(codes, prng)
+    elif method == 'batch':
+        return _batch_order(codes, prng, lim, batch_size, deadline, target)
+    elif method == 'swap':
+        return _swap_order(codes, prng, lim, deadline, target, 
+                           initial=initial)
     else:
-        return frame.groupby(block).apply(_shuffle)
+        return _sample_order(codes, prng, lim, deadline, target)
+
+def _shuffle_worker(args):
+    """
+    Runs one round of searches for :func:`_parallel_shuffle_codes` in a 
+    worker process. The state of the worker's random number generator is 
+    passed in and returned so that its stream continues across rounds, and
+    the ``'swap'`` method continues from the worker's best order so far.
+    """
+    (codes, rules, method, state, lim, batch_size, deadline, target, 
+     initial) = args
+    prng = RandomState()
+    prng.set_state(state)
+    order, repeats, tried = _shuffle_codes(codes, rules, method, prng, lim, 
+                                           batch_size, deadline, target, 
+                                           initial)
+    return order, repeats, tried, prng.get_state()
+
+def _parallel_shuffle_codes(pool, n_jobs, codes, rules, method, prng, lim, 
+                            batch_size, deadline, target, rounds=10):
+    """
+    Searches for an order of a block with restarts spread over a pool of
+    worker processes.
+    
+    Each worker draws from its own random number generator seeded from 
+    `prng`. The `lim` tries are split between the workers and run in 
+    `rounds` rounds. After every round the workers are stopped if any of 
+    them reached `target`, and the best order is kept, with ties going to 
+    the earliest round and the lowest worker. Because workers only stop 
+    between rounds, the result depends only on the seed and `n_jobs`. With 
+    a deadline the workers search in a single round until it passes. With
+    the ``'swap'`` method each worker picks up its search in every round 
+    from the best order it had found, so no progress is lost between 
+    rounds.
+    
+    :return: Positions of the rows in the best order, the number of repeats
+        in that order, and the number of tries.
+    :rtype: tuple
+    """
+    seeds = prng.randint(np.iinfo(np.int32).max, size=n_jobs)
+    states = [RandomState(s).get_state() for s in seeds]
+    
+    per_worker = max(1, -(-lim // n_jobs))
+    round_lim = max(1, -(-per_worker // rounds))
+    
+    best, repeats, tried, done = None, None, 0, 0
+    initials = [None] * n_jobs
+    while True:
+        results = pool.map(_shuffle_worker, 
+                           [(codes, rules, method, state, round_lim, 
+                             batch_size, deadline, target, initial) 
+                            for state, initial in zip(states, initials)])
+        for order, r, t, _ in results:
+            tried += t
+            if repeats is None or r < repeats:
+                best, repeats = order, r
+        states = [result[3] for result in results]
+        if method == 'swap':
+            initials = [result[0] for result in results]
+        done += round_lim
+        if repeats <= target or deadline is not None or done >= per_worker:
+            break
+    
+    return best, repeats, tried
+
+def _sequence_rules(col):
+    """
+    Normalize the `col` argument of :func:`smart_shuffle` to lists of column
+    names and (max_run, min_lag) rules.
+    """
+    if isinstance(col, basestring):
+        col = [col]
+    if not isinstance(col, dict):
+        col = dict((c, {}) for c in col)
+    
+    columns = list(col.keys())
+    rules = [(col[c].get('max_run', 1), col[c].get('min_lag', 0)) 
+             for c in columns]
+    return columns, rules
 
-def smart_shuffle(frame, col, block=None, seed=None, verbose=False, lim=10000):
+def _value_codes(values):
+    """
+    Factorize values for :func:`smart_shuffle`, giving each missing value a
+    code of its own so that missing values never count as repeats.
+    """
+    codes = pd.factorize(values)[0]
+    missing = codes < 0
+    codes[missing] = len(codes) + np.arange(missing.sum())
+    return codes
+
+def smart_shuffle(frame, col, block=None, seed=None, verbose=False, lim=10000,
+                  method='sample', batch_size=100, time_budget=None, 
+                  report=False, n_jobs=1):
     """
     Shuffles trials such that equivalent trials never appear back to back.
     
+    Four methods are available. The ``'sample'`` method tries up to `lim` 
+    random orders and keeps the one with the fewest repeats. The ``'batch'``
+    method does the same, trying `batch_size` orders at a time, see
+    :func:`_batch_order`. The ``'swap'`` method improves a single order with
+    up to `lim` swaps, see :func:`_swap_order`. The ``'greedy'`` method builds
+    an order directly, see :func:`_greedy_order`. It is guaranteed to avoid
+    repeats whenever that is possible.
+    
+    With a `time_budget`, the searching methods run until the time is up
+    instead of stopping after `lim` tries, and return the best order found.
+    The budget covers the whole frame and is split between blocks in
+    proportion to their length.
+    
+    Before searching, the fewest repeats possible in each block are found
+    with :func:`min_repeats`. Searches stop as soon as they reach that bound,
+    and blocks that cannot avoid repeats are reported if `verbose` is True.
+    
+    Rules on several columns can be given at once by passing a dict for `col`,
+    e.g., ``{'response': {'max_run': 3}, 'item': {'min_lag': 5}}`` for no
+    more than 3 identical responses in a row and at least 5 other trials
+    between repeats of an item. Orders are then built by
+    :func:`_constrained_order` for up to `lim` tries and `method` is not used.
+    
     :param pandas.DataFrame frame: Trials to be shuffled.
-    :param str col: Column of values to minimize repetitions.
-    :param block: Column to groupby before shuffling.
-    :type block: str or None
+    :param col: Column of values to minimize repetitions, several such 
+        columns, or a dict of columns to rules with optional ``'max_run'``
+        (defaults to 1) and ``'min_lag'`` (defaults to 0) keys. A trial that
+        breaks any rule counts as a repeat.
+    :type col: str, list, or dict
+    :param block: Column or columns to groupby before shuffling.
+    :type block: str, list, or None
     :param seed: Seed random number generator.
     :type seed: int or None
     :param bool verbose: Should the status of randomization be printed? Defaults
         to False.
-    :param int lim: Maximum number of shuffles before giving up. Defaults to
-        10000.
-    :returns: Trial list with rows in randomized order.
-    :rtype: pandas.DataFrame
+    :param int lim: Maximum number of shuffles, or swaps with the ``'swap'``
+        method, before giving up. Defaults to 10000.
+    :param str method: One of ``'sample'``, ``'batch'``, ``'swap'``, or 
+        ``'greedy'``. Defaults to ``'sample'``.
+    :param int batch_size: Number of orders to try at once with the 
+        ``'batch'`` method. Defaults to 100.
+    :param time_budget: Seconds to spend searching. Replaces `lim`.
+    :type time_budget: float or None
+    :param bool report: Should a report of the search be returned? Defaults
+        to False.
+    :param int n_jobs: Number of worker processes to spread restarts over.
+        Results are reproducible for a given `seed` and `n_jobs`, but differ
+        between values of `n_jobs`. Defaults to 1.
+    :returns: Trial list with rows in randomized order. If `report` is True,
+        also returns a pandas.DataFrame with the number of repeats left, the
+        fewest repeats possible, the number of tries, and the seconds spent
+        for each block.
+    :rtype: pandas.DataFrame or tuple
     """
+    if method not in ('sample', 'batch', 'swap', 'greedy'):
+        raise ValueError('unknown shuffle method %r' % (method,))
+    
+    if not len(frame):
+        return _shuffle_result(frame.copy(), [], block, report)
+    
     prng = RandomState(seed)
-        
-    def _shuffle(chunk):
-        orig_index = chunk.index
-        repeats = None
-        for i in xrange(lim):
-            new = chunk.reindex(prng.permutation(chunk.index))
-            r = (new[col][1:]==new[col][:-1]).sum()
-            if repeats is None or r < repeats:
-                repeats = r
-                chunk = new
-            if repeats == 0:
-                break
-        if i==lim-1 and verbose:
-            print 'Iteration limit reached! Minimum repeats: ', str(repeats)
-        
-        chunk.index = orig_index
-        return chunk
     
     if block is None:
-        return _shuffle(frame)
+        block_codes, block_keys = np.zeros(len(frame), dtype=int), [None]
     else:
-        return frame.groupby(block).apply(_shuffle)
+        grouped = frame.groupby(block, sort=True)
+        block_codes = grouped.ngroup().values
+        block_keys = list(grouped.size().index)
+    
+    columns, rules = _sequence_rules(col)
+    values = np.column_stack([_value_codes(frame[c]) for c in columns])
+    
+    pool = Pool(n_jobs) if n_jobs > 1 else None
+    
+    order = np.arange(len(frame))
+    searches = []
+    try:
+        for code, key in enumerate(block_keys):
+            rows = np.nonzero(block_codes == code)[0]
+            codes = values[rows]
+            bound = max(min_repeats(codes[:, j], max_run, min_lag) 
+                        for j, (max_run, min_lag) in enumerate(rules))
+            if bound > 0 and verbose:
+                print 'Block %s cannot avoid repeats! Minimum repeats: %d' % \
+                    (key, bound)
+            
+            start = time()
+            deadline = None
+            if time_budget is not None:
+                deadline = start + time_budget * len(rows) / float(len(frame))
+            
+            if pool is None:
+                chunk_order, repeats, tried = _shuffle_codes(
+                    codes, rules, method, prng, lim, batch_size, deadline, 
+                    bound)
+            else:
+                chunk_order, repeats, tried = _parallel_shuffle_codes(
+                    pool, n_jobs, codes, rules, method, prng, lim, 
+                    batch_size, deadline, bound)
+            
+            if repeats > bound and verbose:
+                print 'Iteration limit reached! Minimum repeats: ', \
+                    str(repeats)
+            
+            order[rows] = rows[chunk_order]
+            searches.append((key, (repeats, bound, tried, time() - start)))
+    finally:
+        if pool is not None:
+            pool.terminate()
+    
+    shuffled = frame.take(order)
+    shuffled.index = frame.index
+    return _shuffle_result(shuffled, searches, block, report)
+
+def _shuffle_result(shuffled, searches, block, report):
+    """
+    Return the shuffled frame from :func:`smart_shuffle`, along with a 
+    report of the search for each block if `report` is True.
+    """
+    if not report:
+        return shuffled
+    
+    blocks = list(block) if isinstance(block, list) else [block]
+    if len(blocks) == 1:
+        searches = [((key, ) + search) for key, search in searches]
+    else:
+        searches = [(key + search) for key, search in searches]
+    
+    searches = pd.DataFrame(searches, columns=blocks + ['repeats', 'bound', 
+                                                        'iterations', 
+                                                        'seconds'])
+    return shuffled, searches.set_index(blocks)
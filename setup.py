@@ -28,5 +28,5 @@ setup(
     ],
     
     packages = find_packages(exclude=['contrib', 'docs', '*.tests*']),
-    install_requires=['pandas', 'numpy']
+    install_requires=['pandas>=0.20.2', 'numpy>=1.13.0']
 )